@@ -0,0 +1,97 @@
+"""The cumulative json archive of every post.
+
+Posts are sharded by month into data/YYYY/MM.json, and data/index.json lists
+the shards. Adding a post only touches its shard and the index.
+"""
+
+import json
+import os
+
+from models import Post
+
+INDEX_PATH = os.path.join('data', 'index.json')
+
+
+def month_shard_path(year, month):
+    """Return the path of the shard for a month."""
+    return os.path.join('data', '%04d' % year, '%02d.json' % month)
+
+
+def shard_path(post):
+    """Return the path of the shard that holds post."""
+    year, month, _ = post.date
+    return month_shard_path(year, month)
+
+
+def _dumps(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+
+def shard_contents(posts):
+    """Return the json of a shard holding posts, ordered by date and title."""
+    posts = sorted(posts, key=lambda p: (p.date, p.jekyll_fname()))
+    return _dumps([p._asdict() for p in posts])
+
+
+def read_shard(contents):
+    """Return the Posts in shard_contents output."""
+    return [Post(**p) for p in json.loads(contents)]
+
+
+def add_to_shard(contents, post):
+    """Return shard contents with post added, replacing any post
+    with the same date, subject and author.
+
+    :param contents: existing shard contents, or None.
+    """
+
+    posts = read_shard(contents) if contents else []
+    posts = [p for p in posts
+             if (p.date, p.subject, p.author) !=
+             (post.date, post.subject, post.author)]
+
+    return shard_contents(posts + [post])
+
+
+def index_contents(shard_counts):
+    """Return the json of the index.
+
+    :param shard_counts: a dict of {shard path: number of posts}.
+    """
+
+    shards = [{'path': path, 'count': count}
+              for path, count in sorted(shard_counts.items())]
+
+    return _dumps({'count': sum(shard_counts.values()), 'shards': shards})
+
+
+def update_index(contents, shard, count):
+    """Return index contents with shard's count set.
+
+    :param contents: existing index contents, or None.
+    """
+
+    shard_counts = {}
+    if contents:
+        shard_counts = dict((s['path'], s['count'])
+                            for s in json.loads(contents)['shards'])
+
+    shard_counts[shard] = count
+
+    return index_contents(shard_counts)
+
+
+def files_to_update(post, shard, index):
+    """Return (filepath, contents) pairs that add post to the archive.
+
+    :param shard: the contents of post's shard, or None.
+    :param index: the contents of the index, or None.
+    """
+
+    new_shard = add_to_shard(shard, post)
+    count = len(json.loads(new_shard))
+
+    return [
+        (shard_path(post), new_shard),
+        (INDEX_PATH, update_index(index, shard_path(post), count)),
+    ]
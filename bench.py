@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the render pipeline, run against a synthetic corpus.
+
+Each stage runs in a fresh process, so peak memory is per stage::
+
+    python bench.py --posts 10000 --save bench_baseline.json
+    python bench.py --posts 10000 --compare bench_baseline.json
+
+Stages are timed --repeat times and the fastest run is kept, since a single
+run on a shared machine can be well over the comparison's tolerance.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import Queue
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+#tla and bootstrap read these at import; the benchmarks never go online.
+for key in ('GH_USER', 'GH_SECRET', 'CIO_KEY', 'CIO_SECRET', 'CIO_AID'):
+    os.environ.setdefault(key, 'bench')
+
+import bootstrap
+from models import Post
+import tla
+
+WORDS = ('the a of to and in that is was he for it with as his on be at by '
+         'I had not are but from or have an they which one you were her all '
+         'she there would their we him been has when who will more no if out '
+         'listserve email lottery people write thousands strangers').split()
+
+UNICODE_WORDS = (u'café naïve façade jalapeño Ωμέγα Привет мир 你好 世界 '
+                 u'こんにちは 안녕하세요 שלום مرحبا ☃ ♥ 🙂 — “quoted” …').split()
+
+FOOTER = (u'\r\n\r\n--\r\n\r\nYou are receiving this email because you '
+          u'subscribed to The Listserve.\r\nunsubscribe from this list')
+
+
+def make_body(rng, unicode_heavy):
+    words = WORDS + UNICODE_WORDS * (10 if unicode_heavy else 0)
+
+    paras = []
+    for _ in range(rng.randint(3, 12)):
+        lines = []
+        for _ in range(rng.randint(1, 5)):
+            lines.append(u' '.join(rng.choice(words)
+                                   for _ in range(rng.randint(5, 20))))
+        paras.append(u'\r\n'.join(lines))
+
+    return u'\r\n\r\n'.join(paras) + FOOTER
+
+
+def make_cio_message(i, rng, unicode_heavy=False):
+    """Return a Context.IO message (with body) like test_data.cio_email."""
+
+    words = UNICODE_WORDS if unicode_heavy else WORDS
+    subject = u' '.join(rng.choice(words) for _ in range(rng.randint(0, 8)))
+
+    return {
+        u'addresses': {
+            u'from': {u'email': u'no-reply@thelistserve.com',
+                      u'name': u'Author %s' % i},
+        },
+        u'body': [{u'content': make_body(rng, unicode_heavy),
+                   u'type': u'text/plain'}],
+        #About one post a day, starting in 2012.
+        u'date': 1346778877 + i * 86400 + rng.randint(-3600, 3600),
+        u'message_id': u'%024x' % i,
+        u'subject': u'[The Listserve] ' + subject,
+    }
+
+
+def make_corpus(n, unicode_fraction=0.1, seed=0):
+    """Return a list of n Context.IO messages."""
+    rng = random.Random(seed)
+    return [make_cio_message(i, rng, rng.random() < unicode_fraction)
+            for i in range(n)]
+
+
+def make_posts(n, unicode_fraction=0.1, seed=0):
+    return [Post.from_cio_message(m)
+            for m in make_corpus(n, unicode_fraction, seed)]
+
+
+class InTempDir(object):
+    """Run in a fresh temporary directory, with stdout discarded."""
+
+    def __enter__(self):
+        self.cwd = os.getcwd()
+        self.stdout = sys.stdout
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout = self.stdout
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+
+def bench_from_cio_message(args):
+    msgs = make_corpus(args.posts, args.unicode)
+    start = time.time()
+    for m in msgs:
+        Post.from_cio_message(m)
+    return time.time() - start
+
+
+def _bench_post_method(method):
+    def bench(args):
+        posts = make_posts(args.posts, args.unicode)
+        start = time.time()
+        for post in posts:
+            method(post)
+        return time.time() - start
+    return bench
+
+
+def bench_files_to_create(args):
+    posts = make_posts(args.posts, args.unicode)
+    start = time.time()
+    for post in posts:
+        tla.files_to_create(post)
+    return time.time() - start
+
+
+def bench_write_out(args):
+    posts = make_posts(args.posts, args.unicode)
+    with InTempDir():
+        start = time.time()
+        bootstrap._write_out(posts, yaml=True, supporting=True)
+        return time.time() - start
+
+
+def bench_rebuild(args):
+    posts = make_posts(args.posts, args.unicode)
+    with InTempDir():
+        bootstrap._write_out(posts, yaml=True, supporting=False)
+        start = time.time()
+        bootstrap.rebuild('manifest.json', force=True, workers=args.workers)
+        return time.time() - start
+
+
+STAGES = [
+    ('from_cio_message', bench_from_cio_message),
+    ('body_as_html', _bench_post_method(Post.body_as_html)),
+    ('to_jekyll_html', _bench_post_method(Post.to_jekyll_html)),
+    ('files_to_create', bench_files_to_create),
+    ('_write_out', bench_write_out),
+    ('rebuild_from_yaml', bench_rebuild),
+]
+
+
+def _run_in_child(bench, args, results):
+    seconds = bench(args)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((seconds, peak_kb))
+
+
+def run_stage(bench, args):
+    """Return (seconds, peak rss in KB) of running bench in a new process.
+
+    Raise RuntimeError if it dies, or takes longer than args.timeout."""
+
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_in_child,
+                                    args=(bench, args, results))
+    child.start()
+    deadline = time.time() + args.timeout
+
+    try:
+        while True:
+            try:
+                seconds, peak_kb = results.get(timeout=1)
+                break
+            except Queue.Empty:
+                if not child.is_alive():
+                    raise RuntimeError("exited with %s" % child.exitcode)
+                if time.time() > deadline:
+                    raise RuntimeError("took over %ss" % args.timeout)
+    except RuntimeError:
+        child.terminate()
+        raise
+    finally:
+        child.join()
+
+    return seconds, peak_kb
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of descriptions of stages that regressed."""
+
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+
+        old, new = baseline[name]['posts_per_sec'], result['posts_per_sec']
+        if new < old * (1 - tolerance):
+            regressions.append("%s: %.0f posts/sec, down from %.0f"
+                               % (name, new, old))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--posts', type=int, default=1000,
+                        help='size of the corpus (default: %(default)s)')
+    parser.add_argument('--unicode', type=float, default=0.1,
+                        help='fraction of unicode-heavy posts '
+                             '(default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes for rebuild_from_yaml '
+                             '(default: %(default)s)')
+    parser.add_argument('--stages', nargs='+', metavar='STAGE',
+                        choices=[name for name, _ in STAGES],
+                        help='only run these stages')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each stage, keeping the fastest '
+                             '(default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds a stage may take (default: %(default)s)')
+    parser.add_argument('--save', metavar='PATH',
+                        help='store results as a baseline')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='fail if slower than this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional slowdown when comparing '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    results = {}
+    print "%-20s %10s %14s %12s" % ('stage', 'seconds', 'posts/sec', 'peak MB')
+
+    for name, bench in STAGES:
+        if args.stages and name not in args.stages:
+            continue
+
+        try:
+            runs = [run_stage(bench, args) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            sys.exit("%s %s" % (name, e))
+
+        seconds = min(s for s, _ in runs)
+        peak_kb = max(kb for _, kb in runs)
+
+        results[name] = {
+            'posts': args.posts,
+            'seconds': seconds,
+            'posts_per_sec': args.posts / seconds,
+            'peak_kb': peak_kb,
+            'repeat': args.repeat,
+        }
+        print "%-20s %10.3f %14.0f %12.1f" % (
+            name, seconds, args.posts / seconds, peak_kb / 1024.0)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for regression in regressions:
+            print "REGRESSION", regression
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
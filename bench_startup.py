@@ -0,0 +1,136 @@
+"""A benchmark of tla's cold start: how soon the first webhook is answered.
+
+Each run is a fresh interpreter, like a dyno waking up::
+
+    python bench_startup.py --runs 10 --budget 0.5
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+#Imported alone, each in a fresh interpreter, for the breakdown.
+MODULES = ('flask', 'requests', 'rauth', 'github', 'yaml', 'slugify', 'pytz',
+           'models', 'githubx', 'tla')
+
+#These shouldn't be needed until a post is handled.
+LAZY_MODULES = ('rauth', 'github', 'yaml', 'models', 'githubx', 'archive')
+
+
+def _median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def child_first_webhook():
+    """Import tla and answer a webhook, then build what was deferred.
+
+    Print the times since START, the moment the parent started us."""
+
+    start = float(os.environ['START'])
+
+    import tla
+    imported = time.time()
+
+    timestamp, token = int(time.time()), 'bench'
+    webhook = {
+        'account_id': 'bench',
+        'message_data': {'message_id': 'bench'},
+        'timestamp': timestamp,
+        'token': token,
+        'signature': hmac.new(tla.app.config['CIO_SECRET'],
+                              msg=str(timestamp) + token,
+                              digestmod=hashlib.sha256).hexdigest(),
+    }
+    response = tla.app.test_client().post(
+        '/cio/webhook', data=json.dumps(webhook),
+        content_type='application/json')
+    assert response.status_code == 200, response.status_code
+    answered = time.time()
+
+    loaded = [m for m in LAZY_MODULES if m in sys.modules]
+
+    tla.cio_requests()
+    tla.githubx()
+    import models
+    deferred = time.time()
+
+    print json.dumps({
+        'import': imported - start,
+        'first_webhook': answered - start,
+        'deferred_init': deferred - answered,
+        'loaded_early': loaded,
+    })
+
+
+def child_import(module):
+    start = time.time()
+    __import__(module)
+    print json.dumps(time.time() - start)
+
+
+def run_child(args, env):
+    env = dict(env, START=repr(time.time()))
+    out = subprocess.check_output([sys.executable, __file__] + args, env=env)
+    return json.loads(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='cold starts to take the median of '
+                             '(default: %(default)s)')
+    parser.add_argument('--budget', type=float,
+                        help='fail if the first webhook takes longer than '
+                             'this many seconds')
+    parser.add_argument('--child', nargs='+', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        if args.child[0] == 'webhook':
+            child_first_webhook()
+        else:
+            child_import(args.child[1])
+        return
+
+    spool = tempfile.mkdtemp()
+    env = dict(os.environ, SPOOL_DIR=spool, DEDUP_PATH='')
+    for key in ('GH_USER', 'GH_SECRET', 'CIO_KEY', 'CIO_SECRET'):
+        env.setdefault(key, 'bench')
+
+    try:
+        runs = [run_child(['--child', 'webhook'], env)
+                for _ in range(args.runs)]
+
+        print "%-20s %10s" % ('module', 'import s')
+        for module in MODULES:
+            seconds = _median([run_child(['--child', 'import', module], env)
+                               for _ in range(args.runs)])
+            print "%-20s %10.3f" % (module, seconds)
+    finally:
+        shutil.rmtree(spool)
+
+    print
+    for key, label in (('import', 'start to tla imported'),
+                       ('first_webhook', 'start to first webhook answered'),
+                       ('deferred_init', 'clients and models, on first post')):
+        print "%-36s %.3fs" % (label, _median([run[key] for run in runs]))
+
+    loaded = set(m for run in runs for m in run['loaded_early'])
+    if loaded:
+        print "loaded before the first webhook:", ', '.join(sorted(loaded))
+
+    first_webhook = _median([run['first_webhook'] for run in runs])
+    if args.budget is not None and first_webhook > args.budget:
+        print "OVER BUDGET: %.3fs > %.3fs" % (first_webhook, args.budget)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
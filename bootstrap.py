@@ -1,24 +1,32 @@
 """A little utility for manually patching in posts."""
 
 import argparse
+import calendar
 import codecs
+from collections import deque, OrderedDict
 import datetime
+import email
 import errno
 from glob import glob
+from itertools import groupby, islice
+import multiprocessing
 import os
 import pprint
 import time
 import subprocess
 import sys
 
-from rauth import OAuth1Session
-import yaml
+from concurrent.futures import ThreadPoolExecutor
 
-from models import Post
+import archive
+from githubx import GroupCommitter
+from localgit import LocalGitx
+from manifest import Manifest, content_hash
+from models import Post, body_include, read_day_index, read_frontmatter
 import tla
 
-aid = os.environ['CIO_AID']
-cio_requests = OAuth1Session(os.environ['CIO_KEY'], os.environ['CIO_SECRET'])
+#Only needed to download from Context.IO.
+aid = os.environ.get('CIO_AID')
 
 
 def mkdir_p(path):
@@ -48,55 +56,379 @@ def git_checkout_branch(name):
 
 
 def _write_out(posts, yaml=True, supporting=False):
-    for p in posts:
-        for path, contents in tla.files_to_create(p):
+    """Write the files of posts to the working tree.
+
+    Unless supporting is set, only _posts files are written, and the day
+    indexes and archive aren't read; rebuild_from_yaml makes them."""
+
+    def files(post):
+        if not supporting:
+            return tla.files_to_create(
+                post, fname=tla.post_fname(post, read=_read_if_exists))
+
+        day_entries = _day_entries_on_disk(post)
+        return (tla.files_to_create(
+                    post, day_entries,
+                    fname=tla.post_fname(post, day_entries, _read_if_exists)) +
+                _archive_files_on_disk(post))
+
+    _write_files((files(p) for p in posts), yaml, supporting)
+
+
+def _read_if_exists(path):
+    if not os.path.exists(path):
+        return None
+
+    with codecs.open(path, 'r', 'utf-8') as f:
+        return f.read()
+
+
+def _day_entries_on_disk(post):
+    """Return the entries in the local day index for post's day."""
+
+    day_index = _read_if_exists(tla.day_index_path(post))
+    return read_day_index(day_index) if day_index else []
+
+
+def _archive_files_on_disk(post):
+    """Return the files that add post to the local cumulative archive."""
+    return archive.files_to_update(
+        post,
+        shard=_read_if_exists(archive.shard_path(post)),
+        index=_read_if_exists(archive.INDEX_PATH))
+
+
+def _write_files(file_lists, yaml=True, supporting=False):
+    """Write out an iterable of tla.files_to_create results."""
+
+    for files in file_lists:
+        for path, contents in files:
             if path.startswith('_posts') and not yaml:
                 continue
             if not path.startswith('_posts') and not supporting:
                 continue
 
-            mkdir_p(os.path.dirname(path))
+            _write_file(path, contents)
+
+
+def _write_file(path, contents):
+    mkdir_p(os.path.dirname(path))
+
+    with codecs.open(path, 'w', 'utf-8') as f:
+        f.write(contents)
 
-            with codecs.open(path, 'w', 'utf-8') as f:
-                f.write(contents)
+    print path
+
+
+def _get_message_page(params, offset, limit):
+    """Return a list of messages from the Context.IO /messages endpoint."""
+
+    req = tla.cio_requests().get(
+        tla.app.config['CIO_BASE_URL'] + '/2.0/accounts/' + aid + '/messages',
+        params=dict(params, offset=offset, limit=limit))
+
+    try:
+        msgs = req.json()
+    except ValueError:
+        msgs = None
 
-            print path
+    if not isinstance(msgs, list):
+        raise Exception("did not receive json at offset %s: %r"
+                        % (offset, req.content))
+
+    return msgs
+
+
+def _message_pages(params, page_size, workers):
+    """Yield pages of messages in order, until a page isn't full.
+
+    Up to workers pages are fetched at once."""
+
+    executor = ThreadPoolExecutor(workers)
+    pending = deque()
+    offset = 0
+
+    try:
+        while True:
+            while len(pending) < workers:
+                pending.append(executor.submit(
+                    _get_message_page, params, offset, page_size))
+                offset += page_size
+
+            page = pending.popleft().result()
+            yield page
+
+            if len(page) < page_size:
+                return
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
 
 
 def dl_after(args):
-    """Download posts received after args.date and write them to _posts."""
+    """Download posts received after args.date and write them to _posts.
 
-    git_checkout_branch('gh-pages')
+    Posts are written as their pages arrive, oldest first. With
+    args.local_repos, each is committed to a bare repo there instead, and the
+    branch is pushed to args.push (if given) at the end. With args.github,
+    each is committed to GitHub, as tla would."""
+
+    if not (args.local_repos or args.github):
+        git_checkout_branch('gh-pages')
 
     date = datetime.datetime(*[int(i) for i in args.date.split('-')])
     date -= datetime.timedelta(hours=5)
     tstamp = time.mktime(date.timetuple())
 
-    #Download
-    msgs = []
+    pages = _message_pages({'folder': 'thelistserve',
+                            'include_body': 1,
+                            'body_type': 'text/plain',
+                            'date_after': tstamp,
+                            'sort_order': 'asc',
+                            },
+                           args.page_size, args.workers)
+
+    posts = (Post.from_cio_message(m) for page in pages for m in page)
+
+    _publish(posts, args)
+
+
+def import_mail(args):
+    """Import the posts in an mbox file or Maildir at args.path.
+
+    The mailbox is read once, and messages are parsed by a pool of
+    args.workers processes; posts are published as they're parsed, in
+    mailbox order, like dl_after's. Messages that aren't posts are skipped."""
+
+    if not (args.local_repos or args.github):
+        git_checkout_branch('gh-pages')
+
+    skipped = [0]  # in a list so posts() can count
+
+    def posts():
+        for post in _read_mail(args.path, args.workers, args.chunksize):
+            if post is None:
+                skipped[0] += 1
+            else:
+                yield post
+
+    _publish(posts(), args)
+
+    if skipped[0]:
+        print >> sys.stderr, "skipped %s messages that aren't posts" % (
+            skipped[0])
+
 
-    req = cio_requests.get(
-        'https://api.context.io/2.0/accounts/' + aid + '/messages',
-        params={'folder': 'thelistserve',
-                'include_body': 1,
-                'body_type': 'text/plain',
-                'date_after': tstamp,
-                'sort_order': 'asc',
-                }
+def _read_mail(path, workers=1, chunksize=100):
+    """Yield the Post of each message in an mbox file or Maildir, in order,
+    or None for messages that aren't posts."""
+
+    if os.path.isdir(path):
+        items, parse = _maildir_paths(path), _post_from_mail_file
+    else:
+        items, parse = _mbox_messages(path), _post_from_raw_mail
+
+    return _imap_workers(parse, items, workers, chunksize)
+
+
+def _mbox_messages(path):
+    """Yield each message of an mbox file as a bytestring.
+
+    Unlike mailbox.mbox, the file is read once, front to back."""
+
+    lines = []
+
+    with open(path, 'rb') as f:
+        for line in f:
+            #Like mailbox.mbox, any line starting with "From " separates.
+            if line.startswith('From '):
+                if lines:
+                    yield ''.join(lines)
+                lines = []
+            else:
+                lines.append(line)
+
+    if lines:
+        yield ''.join(lines)
+
+
+def _maildir_paths(path):
+    """Yield the path of each message in a Maildir, oldest delivery first."""
+
+    for subdir in ('cur', 'new'):
+        subdir = os.path.join(path, subdir)
+        if os.path.isdir(subdir):
+            for fname in sorted(os.listdir(subdir)):
+                if not fname.startswith('.'):
+                    yield os.path.join(subdir, fname)
 
-    )
 
-    if req.json():
-        msgs += req.json()
+def _post_from_raw_mail(raw):
+    """Return the Post of a message bytestring, or None."""
+    try:
+        return Post.from_email(email.message_from_string(raw))
+    except ValueError:
+        return None
+
+
+def _post_from_mail_file(path):
+    with open(path, 'rb') as f:
+        return _post_from_raw_mail(f.read())
+
+
+def _publish(posts, args):
+    """Write posts to the working tree, or commit them where args say."""
+
+    if args.local_repos:
+        _commit_locally(posts, args.local_repos, args.push)
+    elif args.github:
+        _commit_to_github(posts, args.batch)
     else:
-        print "did not receive json!"
-        print "%r" % req.content
-        print "terminating without writing out"
+        _write_out(posts)
+
+
+def _commit_locally(posts, root, remote=None):
+    """Commit each post to the bare repo root/the-listserve-archive.git, as
+    tla would, then push it to remote once."""
+
+    local = LocalGitx(root)
+    count = 0
+
+    for post in posts:
+        local.commit(repo='the-listserve-archive',
+                     file_descriptions=tla.post_files_builder(post),
+                     commit_message="add post (%s)" % post.datestr(),
+                     branch='gh-pages')
+        count += 1
+
+    local.close()
+    print "committed %s posts" % count
+
+    if remote is not None and count:
+        local.push('the-listserve-archive', 'gh-pages', remote)
+
+
+def _commit_to_github(posts, batch=50):
+    """Commit posts to GitHub as tla would, batch posts to a commit.
+
+    The commits are paced by the rate limit, leaving tla's reserve of it for
+    posts arriving meanwhile."""
+
+    #Batches fill up long before the window ends; it only flushes a slow
+    #source's stragglers.
+    committer = GroupCommitter(tla.githubx().bulk(), window=60,
+                               max_changes=batch)
+    futures = []
+
+    for post in posts:
+        futures.append(committer.submit(
+            repo='the-listserve-archive',
+            file_descriptions=tla.post_files_builder(post),
+            commit_message="add post (%s)" % post.datestr(),
+            branch='gh-pages'))
+
+        if futures[-1].done():
+            #A full batch was just committed; stop if it failed.
+            futures[-1].result()
+
+    committer.flush()
+    for future in futures:
+        future.result()
+
+    print "committed %s posts in %s commits" % (
+        len(futures), len(set(future.result() for future in futures)))
+
+
+def _map_chunk(func, chunk):
+    return [func(item) for item in chunk]
+
+
+def _imap_bounded(pool, func, items, chunksize, in_flight):
+    """Like pool.imap, but with at most in_flight chunks pending at once.
+
+    Results are yielded in order."""
+
+    items = iter(items)
+    pending = deque()
+
+    while True:
+        chunk = list(islice(items, chunksize))
+        if chunk:
+            pending.append(pool.apply_async(_map_chunk, (func, chunk)))
+
+        if pending and (len(pending) >= in_flight or not chunk):
+            for result in pending.popleft().get():
+                yield result
+        elif not chunk:
+            return
+
+
+def _imap_workers(func, items, workers, chunksize):
+    """Yield func(item) for each of items, in order.
+
+    The calls are made by a pool of processes if workers > 1."""
+
+    if workers == 1:
+        for item in items:
+            yield func(item)
         return
 
-    posts = [Post.from_cio_message(m) for m in msgs]
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in _imap_bounded(pool, func, items,
+                                    chunksize, in_flight=2 * workers):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
 
-    _write_out(posts)
+def _post_from_yaml(fname):
+    """Return the Post stored in the frontmatter of a _posts file."""
+
+    frontmatter = read_frontmatter(fname)
+    return Post(**frontmatter['api_data']['post'])
+
+
+def _post_month(fname):
+    """Return the 'YYYY-MM' prefix of a _posts filename."""
+    return os.path.basename(fname)[:len('YYYY-MM')]
+
+
+def _files_from_yaml(fnames):
+    """Return (fnames, files), where files are everything generated from the
+    posts in fnames, which must all be from the same month.
+
+    That's the tla.files_to_create output of every post, and their shard
+    of the cumulative archive."""
+
+    posts = [_post_from_yaml(fname) for fname in fnames]
+    names = [os.path.basename(fname) for fname in fnames]
+
+    #Posts on the same day share some files.
+    files = OrderedDict()
+    for _, day in groupby(zip(posts, names), lambda pair: pair[0].date):
+        day = list(day)
+        day_entries = [post.day_index_entry(name) for post, name in day]
+
+        for post, name in day:
+            for path, contents in tla.files_to_create(post, day_entries,
+                                                      fname=name):
+                files[path] = contents
+
+    files[archive.shard_path(posts[0])] = archive.shard_contents(posts)
+
+    return fnames, files.items()
+
+
+def _render_from_yaml(months, workers, chunksize):
+    """Yield (fnames, files) for each list of same-month fnames in months,
+    in order.
+
+    Rendering is done by a pool of processes if workers > 1."""
+
+    return _imap_workers(_files_from_yaml, months, workers, chunksize)
 
 
 def rebuild_from_yaml(args):
@@ -104,18 +436,229 @@ def rebuild_from_yaml(args):
 
     git_checkout_branch('gh-pages')
 
-    posts = []
-    for fname in glob('_posts/*.html'):
-        with codecs.open(fname, 'r', 'utf-8') as f:
-            c = f.read()
-            # we only want the yaml frontmatter
-            start = c.index('---') + 3
-            end = c.rindex('---')
-            frontmatter = yaml.safe_load(c[start:end])
+    rebuild(args.manifest, args.force, args.workers, args.chunksize)
+
+
+def rebuild(manifest_path, force=False, workers=1, chunksize=2):
+    """Rebuild the current directory from ``_posts/*.html``.
+
+    Only posts that changed since the last rebuild (according to the manifest
+    at manifest_path) are rendered, unless force is set. Outputs that are no
+    longer produced by any post are removed.
+
+    Posts are parsed and rendered by a pool of workers processes, but written
+    in order, so output doesn't depend on the number of workers."""
+
+    fnames = sorted(glob('_posts/*.html'))
+
+    #Posts in the same month are rendered together, since they share files.
+    months = [list(month) for _, month in groupby(fnames, _post_month)]
+
+    manifest = Manifest(manifest_path)
+    previous_outputs = manifest.outputs()
+
+    manifest.forget_except(
+        [] if force else [_post_month(month[0]) for month in months])
+
+    renderer = tla.renderer_version()
+    stale = [month for month in months if not manifest.is_fresh(
+        _post_month(month[0]), renderer, month)]
+
+    for month, files in _render_from_yaml(stale, workers, chunksize):
+        unit = _post_month(month[0])
+        outputs = {}
+
+        for path, contents in files:
+            if path.startswith('_posts'):
+                continue
+
+            outputs[path] = content_hash(contents)
+
+            #Avoid touching files that wouldn't change.
+            if (outputs[path] != manifest.output_hash(unit, path) or
+                    not os.path.exists(path)):
+                _write_file(path, contents)
+
+        manifest.record(unit, renderer, month, outputs)
+
+    shard_counts = {}
+    for month in months:
+        year, month_num = [int(i) for i in _post_month(month[0]).split('-')]
+        shard_counts[archive.month_shard_path(year, month_num)] = len(month)
+
+    index = archive.index_contents(shard_counts)
+    if index != _read_if_exists(archive.INDEX_PATH):
+        _write_file(archive.INDEX_PATH, index)
+
+    for path in sorted(previous_outputs - manifest.outputs()):
+        if os.path.exists(path):
+            os.remove(path)
+            print "removed", path
+
+    manifest.save()
+
+
+def compact_posts(args):
+    """Rewrite ``_posts/*.html`` without the html of their bodies, and write
+    that html to their includes, as tla does with POST_HTML_INCLUDES set.
+
+    Only run this once gh-pages' post layout includes bodies."""
+
+    git_checkout_branch('gh-pages')
+
+    fnames = sorted(glob('_posts/*.html'))
+    before = after = included = 0
+
+    for fname, size, contents, include in _imap_workers(
+            _compacted, fnames, args.workers, chunksize=50):
+        before += size
+        if contents is None:
+            after += size
+        else:
+            after += len(contents)
+            _write_file(fname, contents)
 
-            posts.append(Post(**frontmatter['api_data']['post']))
+        include_path, include_contents = include
+        included += len(include_contents)
+        if include_contents != _read_if_exists(include_path):
+            _write_file(include_path, include_contents)
 
-    _write_out(posts, yaml=False, supporting=True)
+    print >> sys.stderr, "_posts: %s files, %s -> %s bytes" % (
+        len(fnames), before, after)
+    print >> sys.stderr, "_includes/posts: %s bytes" % included
+
+
+def _compacted(fname):
+    """Return (fname, size, contents, include), where contents are what fname
+    should hold, or None if it already does, and include is the
+    (path, contents) of its body's html."""
+
+    with open(fname, 'rb') as f:
+        old = f.read()
+
+    #The file keeps its name, even if the post would get another one now.
+    post = _post_from_yaml(fname)
+    name = os.path.basename(fname)
+    _, contents = post.to_jekyll_html(name, html_include=True)
+    include = (os.path.join('_includes', body_include(name)),
+               post.to_jekyll_include())
+
+    return fname, len(old), (contents if contents != old else None), include
+
+
+def export(args):
+    """Write the site generated from ``_posts/*.html`` as a git fast-import
+    stream, without touching the working tree.
+
+    By default, the stream is imported into this repo's args.branch."""
+
+    fnames = sorted(glob('_posts/*.html'))
+    export_args = (fnames, args.branch, args.squash, args.parent, args.workers)
+
+    if args.output == '-':
+        _export(sys.stdout, *export_args)
+    elif args.output:
+        with open(args.output, 'wb') as f:
+            _export(f, *export_args)
+    else:
+        importer = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                                    stdin=subprocess.PIPE)
+        _export(importer.stdin, *export_args)
+        importer.stdin.close()
+
+        if importer.wait() != 0:
+            raise Exception("git fast-import failed")
+
+    print >> sys.stderr, "exported %s posts to %s" % (len(fnames), args.branch)
+
+
+def _fast_import_data(contents):
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+    return 'data %s\n%s\n' % (len(contents), contents)
+
+
+def _export(out, fnames, branch, squash=False, parent=None, workers=1):
+    """Write a fast-import stream of the site generated from fnames to out.
+
+    Without squash, each post gets a commit dated by the post, made from the
+    tla.post_files_builder output, as if it had arrived by webhook. With it,
+    the files are rendered like rebuild_from_yaml does, and written in one
+    commit. The first commit is on parent if given, so eg layouts are kept."""
+
+    ref = 'refs/heads/' + branch
+
+    #"name <email> time tz"
+    ident = subprocess.check_output(['git', 'var', 'GIT_COMMITTER_IDENT'])
+    ident = ident[:ident.index('>') + 1]
+
+    out.write('reset %s\n' % ref)
+    from_line = ['from %s\n' % parent if parent else '']
+
+    def write_commit(when, message, changes):
+        out.write('commit %s\n' % ref)
+        out.write('committer %s %d +0000\n' % (ident, when))
+        out.write(_fast_import_data(message))
+        out.write(from_line.pop() if from_line else '')
+        out.write(''.join(changes))
+
+    if squash:
+        _export_squashed(out, fnames, workers, write_commit)
+        return
+
+    #Contents that later posts read back: the current month's and the index.
+    shared = {}
+    month = None
+
+    for fname in fnames:
+        post = _post_from_yaml(fname)
+
+        #Later posts never read an earlier month's files.
+        if _post_month(fname) != month:
+            month = _post_month(fname)
+            shared = {archive.INDEX_PATH: shared.get(archive.INDEX_PATH)}
+
+        shared_paths = (tla.day_index_path(post), archive.shard_path(post),
+                        archive.INDEX_PATH)
+        changes = []
+
+        builder = tla.post_files_builder(post, os.path.basename(fname))
+        for desc in builder(shared.get):
+            if desc.path in shared_paths:
+                shared[desc.path] = desc.contents
+
+            changes.append('M 100644 inline %s\n' % desc.path)
+            changes.append(_fast_import_data(desc.contents))
+
+        when = calendar.timegm(datetime.date(*post.date).timetuple())
+        write_commit(when, "add post (%s)" % post.datestr(), changes)
+
+
+def _export_squashed(out, fnames, workers, write_commit):
+    """Write blobs of every generated file, then one commit of them."""
+
+    marks = {}  # path -> mark of its blob
+    shard_counts = {}
+
+    def write_blob(path, contents):
+        marks[path] = len(marks) + 1
+        out.write('blob\nmark :%s\n' % marks[path])
+        out.write(_fast_import_data(contents))
+
+    months = [list(month) for _, month in groupby(fnames, _post_month)]
+
+    for month, files in _render_from_yaml(months, workers, chunksize=2):
+        for path, contents in files:
+            write_blob(path, contents)
+
+        year, month_num = [int(i) for i in _post_month(month[0]).split('-')]
+        shard_counts[archive.month_shard_path(year, month_num)] = len(month)
+
+    write_blob(archive.INDEX_PATH, archive.index_contents(shard_counts))
+
+    write_commit(time.time(), "export %s posts" % len(fnames),
+                 ['M 100644 :%s %s\n' % (mark, path)
+                  for path, mark in sorted(marks.items())])
 
 
 def add_manually(args):
@@ -158,6 +701,26 @@ def get_post_from_user():
     return Post(**post_kwargs)
 
 
+def _add_publish_arguments(parser):
+    """Add the options of _publish to a subcommand's parser."""
+
+    destination = parser.add_mutually_exclusive_group()
+    destination.add_argument(
+        '--local-repos', metavar='DIR',
+        help='commit posts to the bare repo DIR/the-listserve-archive.git '
+             '(eg from git clone --bare) instead of the working tree')
+    destination.add_argument(
+        '--github', action='store_true',
+        help='commit posts to GitHub instead of the working tree, within '
+             'the rate limit')
+    parser.add_argument(
+        '--push', metavar='REMOTE',
+        help='with --local-repos, push gh-pages to REMOTE afterwards')
+    parser.add_argument(
+        '--batch', type=int, default=50,
+        help='with --github, posts to commit at once (default: %(default)s)')
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='A tool to manually patch in posts.')
@@ -167,13 +730,81 @@ def main():
         'dl_after',
         help='Download posts through cIO.')
     get_parser.add_argument('date', help='date in YYYY-MM-DD form')
+    get_parser.add_argument(
+        '--page-size', type=int, default=100,
+        help='messages per request; 100 is the most cIO allows '
+             '(default: %(default)s)')
+    get_parser.add_argument(
+        '--workers', type=int, default=4,
+        help='pages to fetch at once (default: %(default)s)')
+    _add_publish_arguments(get_parser)
     get_parser.set_defaults(func=dl_after)
 
+    import_parser = commands.add_parser(
+        'import_mail',
+        help='Import posts from an mbox file or Maildir.')
+    import_parser.add_argument(
+        'path', help='an mbox file, or a Maildir directory')
+    import_parser.add_argument(
+        '--workers', type=int, default=multiprocessing.cpu_count(),
+        help='processes to parse with (default: one per cpu)')
+    import_parser.add_argument(
+        '--chunksize', type=int, default=100,
+        help='messages to send to a worker at once (default: %(default)s)')
+    _add_publish_arguments(import_parser)
+    import_parser.set_defaults(func=import_mail)
+
     rebuild_parser = commands.add_parser(
         'rebuild_from_yaml',
         help='Rebuild all files from from _posts/*.html.')
+    rebuild_parser.add_argument(
+        '--workers', type=int, default=multiprocessing.cpu_count(),
+        help='processes to render with (default: one per cpu)')
+    rebuild_parser.add_argument(
+        '--chunksize', type=int, default=2,
+        help='months of posts handed to a worker at a time '
+             '(default: %(default)s)')
+    rebuild_parser.add_argument(
+        '--manifest', default='.git/rebuild-manifest.json',
+        help='where to record what was built (default: %(default)s)')
+    rebuild_parser.add_argument(
+        '--force', action='store_true',
+        help='rebuild every post, even if it looks unchanged')
     rebuild_parser.set_defaults(func=rebuild_from_yaml)
 
+    compact_parser = commands.add_parser(
+        'compact_posts',
+        help='Move the html of _posts/*.html bodies to _includes/.')
+    compact_parser.add_argument(
+        '--workers', type=int, default=multiprocessing.cpu_count(),
+        help='processes to rewrite with (default: one per cpu)')
+    compact_parser.set_defaults(func=compact_posts)
+
+    export_parser = commands.add_parser(
+        'export',
+        help='Stream the site generated from _posts/*.html to git '
+             'fast-import.')
+    export_parser.add_argument(
+        '--branch', default='gh-pages-export',
+        help='branch to import to; it must not exist, unless it is '
+             'an ancestor of the result (default: %(default)s)')
+    export_parser.add_argument(
+        '--squash', action='store_true',
+        help='make one commit, rather than one per post')
+    export_parser.add_argument(
+        '--parent', metavar='REF',
+        help='build on REF (eg gh-pages, to keep layouts); by default, '
+             'the first commit has no parent')
+    export_parser.add_argument(
+        '--workers', type=int, default=multiprocessing.cpu_count(),
+        help='processes to render with, when squashing '
+             '(default: one per cpu)')
+    export_parser.add_argument(
+        '--output', metavar='PATH',
+        help="write the stream to PATH ('-' for stdout) instead of "
+             "importing it")
+    export_parser.set_defaults(func=export)
+
     manual_add_parser = commands.add_parser(
         'add_manually',
         help='Create post files by manually entering post content.')
@@ -0,0 +1,115 @@
+"""Remembers which webhook deliveries and posts have already been handled."""
+
+import errno
+import os
+from threading import Lock
+
+from filelock import FileLock
+from lru import LRUCache
+
+
+class Deduplicator(object):
+    def __init__(self, maxsize=10000, path=None):
+        """Remember up to maxsize keys.
+
+        If path is given, handled keys are appended to it and reloaded from it,
+        so they survive a restart. Processes sharing a path see each other's
+        handled keys, but not their claims.
+        """
+
+        self.path = path
+
+        self._seen = LRUCache(maxsize)
+        self._in_flight = set()
+        self._mutex = Lock()
+
+        if path is not None:
+            self._log_lock = FileLock(path + '.lock')
+            self._log_id = None  # the inode of the log we've read
+            self._log_offset = 0
+            self._log_lines = 0
+
+            self._compact()
+
+    def _compact(self):
+        """The log only grows, so drop what the cache would forget."""
+
+        with self._log_lock:
+            self._catch_up()
+
+            if self._log_lines > 2 * self._seen.maxsize:
+                with open(self.path + '.tmp', 'w') as f:
+                    f.writelines(key + '\n' for key in self._seen.keys())
+                os.rename(self.path + '.tmp', self.path)
+                self._catch_up()
+
+    def _catch_up(self):
+        """Read keys appended to the log since we last looked."""
+
+        if self.path is None:
+            return
+
+        try:
+            stat = os.stat(self.path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return
+
+        #Compacted by another process: read it all again.
+        if stat.st_ino != self._log_id or stat.st_size < self._log_offset:
+            self._log_id = stat.st_ino
+            self._log_offset = 0
+            self._log_lines = 0
+
+        if stat.st_size == self._log_offset:
+            return
+
+        with open(self.path) as f:
+            f.seek(self._log_offset)
+            data = f.read()
+
+        #A writer might be partway through a line.
+        end = data.rfind('\n') + 1
+        keys = data[:end].splitlines()
+
+        for key in keys:
+            self._seen.put(key, True)
+
+        self._log_offset += end
+        self._log_lines += len(keys)
+
+    def seen(self, key):
+        """Return True if key has been handled."""
+        with self._mutex:
+            self._catch_up()
+            return key in self._seen
+
+    def claim(self, key):
+        """Return False if key has been handled or claimed already;
+        otherwise, claim it and return True."""
+
+        with self._mutex:
+            self._catch_up()
+            if key in self._in_flight or key in self._seen:
+                return False
+
+            self._in_flight.add(key)
+            return True
+
+    def release(self, key):
+        """Give up a claim on key without handling it."""
+        with self._mutex:
+            self._in_flight.discard(key)
+
+    def done(self, key):
+        """Record that key has been handled."""
+
+        with self._mutex:
+            self._in_flight.discard(key)
+            self._seen.put(key, True)
+
+            if self.path is not None:
+                with self._log_lock:
+                    with open(self.path, 'a') as f:
+                        f.write(key + '\n')
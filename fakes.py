@@ -0,0 +1,411 @@
+"""Local stand-ins for the Context.IO message API and the GitHub git data API.
+
+They're enough for tla, bootstrap and Githubx to run offline: point them here
+with CIO_BASE_URL and GH_BASE_URL. Run this module to serve both.
+"""
+
+import argparse
+import base64
+from collections import OrderedDict
+import hashlib
+import json
+import posixpath
+from threading import Lock, Thread
+import time
+
+from flask import Flask, Response, request
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from githubx import git_blob_sha
+
+
+def _json_response(obj, status=200, headers=None):
+    return Response(json.dumps(obj), status=status, headers=headers,
+                    mimetype='application/json')
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class FakeServer(object):
+    def __init__(self, name, host='127.0.0.1', port=0, latency=0):
+        """Serve a Flask app from a background thread.
+
+        :param port: 0 picks a free port; see self.url.
+        :param latency: seconds to wait before answering each request.
+        """
+
+        self.app = Flask(name)
+        self.latency = latency
+
+        if latency:
+            self.app.before_request(lambda: time.sleep(self.latency))
+
+        self._server = make_server(host, port, self.app, threaded=True,
+                                   request_handler=_QuietRequestHandler)
+        self.url = 'http://%s:%s' % (host, self._server.server_port)
+
+    def start(self):
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+
+class FakeContextIO(FakeServer):
+    """Serves messages added with add_message, for any account."""
+
+    def __init__(self, **kwargs):
+        super(FakeContextIO, self).__init__('fake-contextio', **kwargs)
+
+        self.messages = OrderedDict()  # message_id -> message
+
+        route = self.app.route
+        route('/2.0/accounts/<aid>/messages/<mid>')(self._get_message)
+        route('/2.0/accounts/<aid>/messages')(self._list_messages)
+
+    def add_message(self, message):
+        self.messages[message['message_id']] = message
+
+    def _get_message(self, aid, mid):
+        if mid not in self.messages:
+            return _json_response({'type': 'error'}, 404)
+        return _json_response(self.messages[mid])
+
+    def _list_messages(self, aid):
+        msgs = sorted(self.messages.values(), key=lambda m: m['date'])
+
+        date_after = request.args.get('date_after', type=float)
+        if date_after is not None:
+            msgs = [m for m in msgs if m['date'] > date_after]
+
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', 100, type=int)
+
+        return _json_response(msgs[offset:offset + limit])
+
+
+class FakeGitHub(FakeServer):
+    """Serves git data for any repo of one user.
+
+    Branches start out with an empty commit. Trees are stored flat, as
+    {path: (mode, blob sha)}, and ref updates are recorded in ref_updates.
+
+    Like GitHub, it allows rate_limit requests per rate_limit_window seconds,
+    and refuses the rest with a 403. Recursive tree listings longer than
+    truncate_after entries are cut short and marked truncated.
+    """
+
+    def __init__(self, login='fake', branches=('master', 'gh-pages'),
+                 rate_limit=5000, rate_limit_window=3600, truncate_after=None,
+                 **kwargs):
+        super(FakeGitHub, self).__init__('fake-github', **kwargs)
+
+        self.login = login
+        self.branches = branches
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.truncate_after = truncate_after
+
+        self._mutex = Lock()
+        self.blobs = {}  # sha -> bytestring
+        self.trees = {}  # sha -> {path: (mode, blob sha)}
+        self.commits = {}  # sha -> {'tree', 'parents', 'message'}
+        self.refs = {}  # (repo, branch) -> commit sha
+
+        #(time, repo, branch, commit sha, [changed paths])
+        self.ref_updates = []
+
+        self.requests = 0
+        self.conflicts = 0  # ref updates refused
+        self.rate_limited = 0  # requests refused for being over the limit
+
+        self._remaining = rate_limit
+        self._reset = time.time() + rate_limit_window
+
+        self.app.before_request(self._count_request)
+        self.app.after_request(self._rate_limit_headers)
+
+        route = self.app.route
+        route('/user')(self._get_user)
+        route('/repos/<owner>/<repo>')(self._get_repo)
+        route('/repos/<owner>/<repo>/git/refs/heads/<path:branch>',
+              methods=['GET', 'PATCH'])(self._ref)
+        route('/repos/<owner>/<repo>/git/commits/<sha>')(self._get_commit)
+        route('/repos/<owner>/<repo>/git/commits',
+              methods=['POST'])(self._create_commit)
+        route('/repos/<owner>/<repo>/git/trees/<sha>')(self._get_tree)
+        route('/repos/<owner>/<repo>/git/trees',
+              methods=['POST'])(self._create_tree)
+        route('/repos/<owner>/<repo>/git/blobs/<sha>')(self._get_blob)
+        route('/repos/<owner>/<repo>/git/blobs',
+              methods=['POST'])(self._create_blob)
+
+    #Inspection helpers.
+
+    def files(self, repo, branch):
+        """Return {path: contents} at the head of a branch."""
+        tree = self.trees[self.commits[self._head(repo, branch)]['tree']]
+        return dict((path, self.blobs[sha])
+                    for path, (_, sha) in tree.items())
+
+    def _head(self, repo, branch):
+        with self._mutex:
+            if (repo, branch) not in self.refs and branch in self.branches:
+                self.refs[(repo, branch)] = self._store_commit({}, [], 'root')
+            return self.refs.get((repo, branch))
+
+    #Storage.
+
+    def _store_blob(self, contents):
+        if isinstance(contents, unicode):
+            contents = contents.encode('utf-8')
+        sha = git_blob_sha(contents)
+        self.blobs[sha] = contents
+        return sha
+
+    def _store_tree(self, entries):
+        sha = hashlib.sha1(json.dumps(sorted(entries.items()))).hexdigest()
+        self.trees[sha] = entries
+        return sha
+
+    def _store_commit(self, tree, parents, message):
+        tree_sha = self._store_tree(tree) if isinstance(tree, dict) else tree
+        commit = {'tree': tree_sha, 'parents': parents, 'message': message}
+        sha = hashlib.sha1(json.dumps([commit, len(self.commits)])).hexdigest()
+        self.commits[sha] = commit
+        return sha
+
+    def _is_ancestor(self, ancestor, sha):
+        pending = [sha]
+        while pending:
+            sha = pending.pop()
+            if sha == ancestor:
+                return True
+            pending.extend(self.commits[sha]['parents'])
+        return False
+
+    #Rendering.
+
+    def _url(self, owner, repo, *parts):
+        return '/'.join(['%s/repos/%s/%s' % (self.url, owner, repo)] +
+                        list(parts))
+
+    def _ref_json(self, owner, repo, branch):
+        sha = self.refs[(repo, branch)]
+        return {
+            'ref': 'refs/heads/' + branch,
+            'url': self._url(owner, repo, 'git/refs/heads', branch),
+            'object': {'sha': sha, 'type': 'commit',
+                       'url': self._url(owner, repo, 'git/commits', sha)},
+        }
+
+    def _commit_json(self, owner, repo, sha):
+        commit = self.commits[sha]
+        return {
+            'sha': sha,
+            'url': self._url(owner, repo, 'git/commits', sha),
+            'message': commit['message'],
+            'tree': {'sha': commit['tree'],
+                     'url': self._url(owner, repo, 'git/trees', commit['tree'])},
+            'parents': [{'sha': p, 'url': self._url(owner, repo, 'git/commits', p)}
+                        for p in commit['parents']],
+        }
+
+    def _tree_json(self, owner, repo, sha, recursive=False):
+        entries = []
+        dirs = set()
+
+        for path, (mode, blob_sha) in sorted(self.trees[sha].items()):
+            parent = posixpath.dirname(path)
+            while parent:
+                dirs.add(parent)
+                parent = posixpath.dirname(parent)
+
+            if recursive or '/' not in path:
+                entries.append({'path': path, 'mode': mode, 'type': 'blob',
+                                'sha': blob_sha, 'size': len(self.blobs[blob_sha]),
+                                'url': self._url(owner, repo, 'git/blobs', blob_sha)})
+
+        for path in sorted(dirs):
+            if recursive or '/' not in path:
+                #Stored like any other tree, so it can be listed too.
+                with self._mutex:
+                    dir_sha = self._store_tree(dict(
+                        (child[len(path) + 1:], entry)
+                        for child, entry in self.trees[sha].items()
+                        if child.startswith(path + '/')))
+                entries.append({'path': path, 'mode': '040000', 'type': 'tree',
+                                'sha': dir_sha,
+                                'url': self._url(owner, repo, 'git/trees', dir_sha)})
+
+        truncated = (recursive and self.truncate_after is not None and
+                     len(entries) > self.truncate_after)
+        if truncated:
+            entries = entries[:self.truncate_after]
+
+        return {'sha': sha, 'url': self._url(owner, repo, 'git/trees', sha),
+                'tree': entries, 'truncated': truncated}
+
+    #Routes.
+
+    def _count_request(self):
+        with self._mutex:
+            self.requests += 1
+
+            if time.time() >= self._reset:
+                self._remaining = self.rate_limit
+                self._reset = time.time() + self.rate_limit_window
+
+            if self._remaining <= 0:
+                self.rate_limited += 1
+                return _json_response(
+                    {'message': 'API Rate Limit Exceeded for %s.'
+                                % self.login}, 403)
+
+            self._remaining -= 1
+
+    def _rate_limit_headers(self, response):
+        with self._mutex:
+            remaining, reset = self._remaining, self._reset
+
+        response.headers['X-RateLimit-Limit'] = str(self.rate_limit)
+        response.headers['X-RateLimit-Remaining'] = str(remaining)
+        #GitHub's resolution is a second; round up, so clients wait long enough.
+        response.headers['X-RateLimit-Reset'] = str(int(reset) + 1)
+        return response
+
+    def _get_user(self):
+        return _json_response({'login': self.login,
+                               'url': '%s/users/%s' % (self.url, self.login)})
+
+    def _get_repo(self, owner, repo):
+        return _json_response({
+            'name': repo,
+            'full_name': '%s/%s' % (owner, repo),
+            'url': self._url(owner, repo),
+            'owner': {'login': owner,
+                      'url': '%s/users/%s' % (self.url, owner)},
+        })
+
+    def _ref(self, owner, repo, branch):
+        if self._head(repo, branch) is None:
+            return _json_response({'message': 'Not Found'}, 404)
+
+        if request.method == 'PATCH':
+            data = json.loads(request.data)
+
+            with self._mutex:
+                old = self.refs[(repo, branch)]
+                new = data['sha']
+
+                if not data.get('force') and not self._is_ancestor(old, new):
+                    self.conflicts += 1
+                    return _json_response(
+                        {'message': 'Update is not a fast forward'}, 422)
+
+                self.refs[(repo, branch)] = new
+
+                old_tree = self.trees[self.commits[old]['tree']]
+                new_tree = self.trees[self.commits[new]['tree']]
+                changed = sorted(
+                    path for path in set(old_tree) | set(new_tree)
+                    if old_tree.get(path) != new_tree.get(path))
+                self.ref_updates.append(
+                    (time.time(), repo, branch, new, changed))
+
+        return _json_response(self._ref_json(owner, repo, branch))
+
+    def _get_commit(self, owner, repo, sha):
+        if sha not in self.commits:
+            return _json_response({'message': 'Not Found'}, 404)
+        return _json_response(self._commit_json(owner, repo, sha))
+
+    def _create_commit(self, owner, repo):
+        data = json.loads(request.data)
+        with self._mutex:
+            sha = self._store_commit(data['tree'], data['parents'],
+                                     data['message'])
+        return _json_response(self._commit_json(owner, repo, sha), 201)
+
+    def _get_tree(self, owner, repo, sha):
+        if sha not in self.trees:
+            return _json_response({'message': 'Not Found'}, 404)
+        recursive = request.args.get('recursive') not in (None, '0', 'false')
+        return _json_response(self._tree_json(owner, repo, sha, recursive))
+
+    def _create_tree(self, owner, repo):
+        data = json.loads(request.data)
+
+        with self._mutex:
+            entries = dict(self.trees[data['base_tree']]
+                           if 'base_tree' in data else {})
+
+            for el in data['tree']:
+                if el.get('sha') is not None and el['sha'] not in self.blobs:
+                    return _json_response(
+                        {'message': 'tree.sha %s is not a valid blob'
+                                    % el['sha']}, 422)
+
+                if 'content' in el:
+                    entries[el['path']] = (el['mode'],
+                                           self._store_blob(el['content']))
+                elif el.get('sha') is None:
+                    entries.pop(el['path'], None)
+                else:
+                    entries[el['path']] = (el['mode'], el['sha'])
+
+            sha = self._store_tree(entries)
+
+        return _json_response(self._tree_json(owner, repo, sha), 201)
+
+    def _get_blob(self, owner, repo, sha):
+        if sha not in self.blobs:
+            return _json_response({'message': 'Not Found'}, 404)
+        contents = self.blobs[sha]
+        return _json_response({
+            'sha': sha,
+            'url': self._url(owner, repo, 'git/blobs', sha),
+            'content': base64.b64encode(contents),
+            'encoding': 'base64',
+            'size': len(contents),
+        })
+
+    def _create_blob(self, owner, repo):
+        data = json.loads(request.data)
+        contents = data['content']
+        if data.get('encoding') == 'base64':
+            contents = base64.b64decode(contents)
+
+        with self._mutex:
+            sha = self._store_blob(contents)
+
+        return _json_response(
+            {'sha': sha, 'url': self._url(owner, repo, 'git/blobs', sha)}, 201)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--cio-port', type=int, default=5001)
+    parser.add_argument('--github-port', type=int, default=5002)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each response')
+    args = parser.parse_args()
+
+    cio = FakeContextIO(port=args.cio_port, latency=args.latency).start()
+    gh = FakeGitHub(port=args.github_port, latency=args.latency).start()
+
+    print "CIO_BASE_URL=%s" % cio.url
+    print "GH_BASE_URL=%s" % gh.url
+
+    while True:
+        time.sleep(60)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""An advisory lock on a file, shared by every process on the host."""
+
+import fcntl
+from threading import Lock
+
+
+class FileLock(object):
+    def __init__(self, path):
+        """The file at path is created if needed.
+
+        The lock is released when the process exits, however it exits."""
+
+        self.path = path
+        self._file = None
+
+        #Threads of this process queue here, since they'd share self._file.
+        self._mutex = Lock()
+
+    def acquire(self, blocking=True):
+        """Return True once the lock is held, or False if blocking is False
+        and another holder has it."""
+
+        if not self._mutex.acquire(blocking):
+            return False
+
+        f = open(self.path, 'a')
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+
+        try:
+            fcntl.flock(f, flags)
+        except IOError:
+            f.close()
+            self._mutex.release()
+            if blocking:
+                raise
+            return False
+
+        self._file = f
+        return True
+
+    def release(self):
+        #Closing the file drops the lock.
+        self._file.close()
+        self._file = None
+        self._mutex.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -1,92 +1,458 @@
 """Allows use of some high-level git operations at GitHub."""
 
 import base64
-from collections import namedtuple
-from threading import Lock
+from collections import namedtuple, OrderedDict
+import copy
+import hashlib
+from threading import Lock, Timer
+import time
 
-from decorator import decorator
+from concurrent.futures import Future
 import github
 
+from lru import LRUCache
+import metrics
+from ratelimit import BULK, LIVE, RateLimiter
+from transport import Transport
+
+REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    'githubx_request_seconds', 'Latency of GitHub API calls, by method.')
+COMMIT_CONFLICTS = metrics.REGISTRY.counter(
+    'githubx_commit_conflicts_total',
+    'Commits rebuilt because the branch moved underneath them.')
+UNCHANGED_FILES = metrics.REGISTRY.counter(
+    'githubx_unchanged_files_total',
+    'Files left out of commits because the branch already has them.')
+EMPTY_COMMITS = metrics.REGISTRY.counter(
+    'githubx_empty_commits_total',
+    'Commits not made because they would change nothing.')
+TRUNCATED_TREES = metrics.REGISTRY.counter(
+    'githubx_truncated_trees_total',
+    'Recursive tree listings GitHub cut short, so were listed by directory.')
+
 FileDescription = namedtuple('FileDescription', 'path contents executable')
+TreeEntry = namedtuple('TreeEntry', 'sha mode')
 
 
 def file_description(path, contents, executable=False):
     return FileDescription(path, contents, executable)
 
 
+def git_blob_sha(contents):
+    """Return the sha git would give a blob of contents."""
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+    return hashlib.sha1('blob %d\0' % len(contents) + contents).hexdigest()
+
+
 class Githubx:
     def __init__(self, *args, **kwargs):
-        """All parameters are passed to PyGithub."""
+        """All parameters but these are passed to PyGithub.
+
+        :param blob_cache_size: how many file contents to keep in memory.
+        :param tree_cache_size: how many commits' tree indexes to keep.
+        :param transport: a transport.Transport to make calls through.
+        :param commit_lock: held while committing, if given; eg a
+          filelock.FileLock shared by processes committing to the same
+          branches, so they take turns rather than conflict.
+        :param rate_limiter: a ratelimit.RateLimiter to budget calls with.
+
+        Calls are made with live priority; see bulk().
+        """
+
+        blob_cache_size = kwargs.pop('blob_cache_size', 256)
+        tree_cache_size = kwargs.pop('tree_cache_size', 4)
+        self._transport = kwargs.pop('transport', None) or Transport('github')
+        self._commit_lock = kwargs.pop('commit_lock', None)
+        self._rate_limiter = kwargs.pop('rate_limiter', None) or RateLimiter()
+        self._priority = LIVE
+
         self._gh = github.Github(*args, **kwargs)
+
+        #Keyed by repo too: a blob we've seen is only known to be in its repo.
+        self._blobs = LRUCache(blob_cache_size)  # (repo, sha) -> contents
+        self._trees = LRUCache(tree_cache_size)  # commit sha -> tree index
+
+        #Only guards the handle caches; GitHub calls are made without it.
         self._mutex = Lock()
+        self._repos = {}  # name -> Repository
+        self._refs = {}  # (name, branch) -> GitRef
+
+    def bulk(self):
+        """Return a Githubx for backfills and other bulk work.
+
+        It shares this one's caches and rate limit budget, but its calls are
+        paced to leave room for this one's."""
+
+        bulk = copy.copy(self)
+        bulk._priority = BULK
+        return bulk
+
+    def _api(self, method, *args, **kwargs):
+        """Call a PyGithub method that makes a request."""
+        with REQUEST_SECONDS.time(method=method.__name__):
+            return self._transport.call(self._rate_limited, method,
+                                        *args, **kwargs)
+
+    def _rate_limited(self, method, *args, **kwargs):
+        for attempt in (1, 2):
+            self._rate_limiter.acquire(self._priority)
+
+            try:
+                result = method(*args, **kwargs)
+            except github.RateLimitExceededException:
+                #The transport doesn't retry this; its backoff is far shorter
+                #than a window. Wait for the window to reset, then try again.
+                self._rate_limiter.exhausted()
+                if attempt == 2:
+                    raise
+            else:
+                break
+
+        #Objects PyGithub returns keep the headers of their response.
+        headers = getattr(result, '_headers', None) or {}
+        if 'x-ratelimit-remaining' in headers and 'x-ratelimit-reset' in headers:
+            self._rate_limiter.update(int(headers['x-ratelimit-remaining']),
+                                      int(headers['x-ratelimit-reset']))
+
+        return result
+
+    def _repo(self, repo):
+        with self._mutex:
+            if repo not in self._repos:
+                self._repos[repo] = self._api(self._gh.get_user().get_repo,
+                                              repo)
+            return self._repos[repo]
+
+    def _head_ref(self, repo, branch, refresh=False):
+        """Return a GitRef for branch, which may be out of date
+        unless refresh is True."""
 
-    @decorator
-    def _atomic(f, self, *args, **kwargs):
-        """Ensure the decorated method is the only one in this instance
-        modifying GitHub resorces."""
+        key = (repo, branch)
 
         with self._mutex:
-            return f(self, *args, **kwargs)
+            head_ref = self._refs.get(key)
+
+        if head_ref is None or refresh:
+            head_ref = self._api(self._repo(repo).get_git_ref,
+                                 "heads/%s" % branch)
+            with self._mutex:
+                self._refs[key] = head_ref
+
+        return head_ref
 
-    @_atomic
     def commit(self, repo,
                file_descriptions,
                commit_message,
                branch='master',
-               force=False):
-        """Make a commit on GitHub.
+               force=False,
+               attempts=5):
+        """Make a commit on GitHub and return its sha.
 
         If a path exists, it will be replaced; if not, it will be created.
 
+        The branch is only moved if it still points at the commit we built on;
+        if it's moved in the meantime, the commit is rebuilt on the new head,
+        up to ``attempts`` times, after a jittered, growing delay.
+
+        If the new contents depend on existing ones, pass a function as
+        file_descriptions. It's called with a function that returns the
+        contents of a path in the commit being built on (or None), and must
+        return the file descriptions. It's called again for each rebuild, so
+        concurrent changes aren't lost.
+
+        Files that are already at the head are left out, and if nothing
+        would change, no commit is made and the head's sha is returned.
+
         See http://developer.github.com/v3/git/"""
 
-        gh_repo = self._gh.get_user().get_repo(repo)
+        if self._commit_lock is None:
+            return self._commit(repo, file_descriptions, commit_message,
+                                branch, force, attempts)
+
+        #Other holders may have moved the branch, but can't while we hold it.
+        with self._commit_lock:
+            return self._commit(repo, file_descriptions, commit_message,
+                                branch, force, attempts, refresh=True)
+
+    def _commit(self, repo, file_descriptions, commit_message, branch, force,
+                attempts, refresh=False):
+        gh_repo = self._repo(repo)
+
+        #A cached ref saves a request; a stale one just costs a retry.
+        head_ref = self._head_ref(repo, branch, refresh=refresh)
+        fresh = refresh
+
+        attempt = 1
+        while True:
+            base_sha = head_ref.object.sha
+            latest_commit = self._api(gh_repo.get_git_commit, base_sha)
+
+            descs = file_descriptions
+            if callable(descs):
+                descs = descs(lambda path: self._read(repo, base_sha, path))
+
+            #Only paths whose blobs differ from the base tree are sent.
+            index = self._tree_index(repo, base_sha, latest_commit.tree.sha)
+            changes = OrderedDict()  # path -> (TreeEntry, contents)
+
+            for desc in descs:
+                contents = desc.contents
+                if isinstance(contents, unicode):
+                    contents = contents.encode('utf-8')
+
+                entry = TreeEntry(git_blob_sha(contents),
+                                  '100755' if desc.executable else '100644')
+
+                changes.pop(desc.path, None)
+                if index.get(desc.path) == entry:
+                    UNCHANGED_FILES.inc()
+                else:
+                    changes[desc.path] = (entry, contents)
+
+            if not changes and not fresh:
+                #The branch may have moved away from what we're writing.
+                head_ref = self._head_ref(repo, branch, refresh=True)
+                fresh = True
+                if head_ref.object.sha != base_sha:
+                    continue
+
+            if not changes:
+                EMPTY_COMMITS.inc()
+                return base_sha
+
+            tree_els = []
+            for path, (entry, contents) in changes.items():
+                if self._blobs.get((repo, entry.sha)) is not None:
+                    #GitHub has it already; don't upload it again.
+                    el = github.InputGitTreeElement(
+                        path=path, mode=entry.mode, type='blob', sha=entry.sha)
+                else:
+                    el = github.InputGitTreeElement(
+                        path=path, mode=entry.mode, type='blob',
+                        content=contents)
+                tree_els.append(el)
+
+            new_tree = self._api(gh_repo.create_git_tree,
+                                 tree_els, latest_commit.tree)
+
+            new_commit = self._api(gh_repo.create_git_commit,
+                                   message=commit_message,
+                                   parents=[latest_commit],
+                                   tree=new_tree)
+
+            try:
+                self._api(head_ref.edit, sha=new_commit.sha, force=force)
+            except github.GithubException as e:
+                #GitHub rejects a non-fast-forward update with a 422.
+                if e.status != 422 or force or attempt >= attempts:
+                    raise
+                COMMIT_CONFLICTS.inc()
+                #Spread out committers that conflicted, so they don't keep
+                #retrying in lockstep and conflicting again.
+                time.sleep(self._transport.delay(attempt - 1))
+                attempt += 1
+                head_ref = self._head_ref(repo, branch, refresh=True)
+                fresh = True
+            else:
+                #The next commit will most likely build on this one.
+                new_index = dict(index)
+                for path, (entry, contents) in changes.items():
+                    new_index[path] = entry
+                    self._blobs.put((repo, entry.sha), contents)
+                self._trees.put(new_commit.sha, new_index)
+
+                return new_commit.sha
 
-        head_ref = gh_repo.get_git_ref("heads/%s" % branch)
-        latest_commit = gh_repo.get_git_commit(head_ref.object.sha)
+    def _tree_index(self, repo, commit_sha, tree_sha=None):
+        """Return a dict of {path: TreeEntry} for every blob at a commit.
 
-        base_tree = latest_commit.tree
+        Pass the commit's tree_sha if it's known, to save a request."""
 
-        tree_els = [github.InputGitTreeElement(
-            path=desc.path,
-            mode='100755' if desc.executable else '100644',
-            type='blob',
-            content=desc.contents
-        ) for desc in file_descriptions]
+        index = self._trees.get(commit_sha)
 
-        new_tree = gh_repo.create_git_tree(tree_els, base_tree)
+        if index is None:
+            gh_repo = self._repo(repo)
+            if tree_sha is None:
+                tree_sha = self._api(gh_repo.get_git_commit,
+                                     commit_sha).tree.sha
+            tree = self._api(gh_repo.get_git_tree, tree_sha, recursive=True)
 
-        new_commit = gh_repo.create_git_commit(
-            message=commit_message,
-            parents=[latest_commit],
-            tree=new_tree)
+            if tree.raw_data.get('truncated'):
+                #Past GitHub's limit some entries are missing; an index
+                #without them would report files as absent.
+                TRUNCATED_TREES.inc()
+                index = self._walk_tree(gh_repo, tree_sha)
+            else:
+                index = dict((el.path, TreeEntry(el.sha, el.mode))
+                             for el in tree.tree if el.type == 'blob')
+            self._trees.put(commit_sha, index)
 
-        head_ref.edit(sha=new_commit.sha, force=force)
+        return index
+
+    def _walk_tree(self, gh_repo, tree_sha):
+        """Return a dict of {path: TreeEntry} for every blob under a tree,
+        listing it a directory at a time."""
+
+        index = {}
+        pending = [('', tree_sha)]
+
+        while pending:
+            prefix, sha = pending.pop()
+            for el in self._api(gh_repo.get_git_tree, sha).tree:
+                if el.type == 'blob':
+                    index[prefix + el.path] = TreeEntry(el.sha, el.mode)
+                elif el.type == 'tree':
+                    pending.append((prefix + el.path + '/', el.sha))
+
+        return index
+
+    def paths(self, repo, branch='master'):
+        """Return the path of every file at the head of a branch.
+
+        The tree is cached, so a commit made next on the branch won't fetch
+        it again."""
+
+        head_ref = self._head_ref(repo, branch, refresh=True)
+        return list(self._tree_index(repo, head_ref.object.sha))
 
-    @_atomic
     def get_file(self, repo, filepath, branch='master'):
         """Return a unicode string of the file contents.
-        Raise a github.GithubException is the file is not found."""
+        Raise a github.GithubException is the file is not found.
+
+        filepath may be nested, eg '2012/09/04.json'."""
 
         #Raising an exception isn't the best general api, but for my use
         #it makes the most sense; I always expect the file to be there.
 
-        gh_repo = self._gh.get_user().get_repo(repo)
+        head_ref = self._head_ref(repo, branch, refresh=True)
+        contents = self._read(repo, head_ref.object.sha, filepath)
+
+        if contents is None:
+            raise github.UnknownObjectException(
+                404, {'message': 'File not found in repo.'})
+
+        return contents
+
+    def _read(self, repo, commit_sha, filepath):
+        """Return the contents of a file at a commit, or None."""
+
+        entry = self._tree_index(repo, commit_sha).get(filepath)
+
+        if entry is None:
+            return None
+
+        contents = self._blobs.get((repo, entry.sha))
+
+        if contents is None:
+            blob = self._api(self._repo(repo).get_git_blob, entry.sha)
+
+            if blob.encoding == 'base64':
+                contents = base64.b64decode(blob.content)
+            else:
+                contents = blob.content
+
+            self._blobs.put((repo, entry.sha), contents)
+
+        return contents
+
+
+class GroupCommitter(object):
+    def __init__(self, githubx, window=1.0, max_changes=10):
+        """Coalesce commits to the same repo and branch.
+
+        Changes are held until ``window`` seconds after the first one arrives,
+        or until ``max_changes`` are pending, then made in one commit.
+        """
 
-        latest_commit = gh_repo.get_git_ref("heads/%s" % branch)
+        self.githubx = githubx
+        self.window = window
+        self.max_changes = max_changes
 
-        base_tree = gh_repo.get_git_commit(latest_commit.object.sha).tree
+        self._mutex = Lock()
+        self._batches = {}  # (repo, branch) -> [(descs, message, future)]
+        self._timers = {}
+
+    def submit(self, repo, file_descriptions, commit_message, branch='master'):
+        """Queue a commit, like Githubx.commit.
+
+        If file_descriptions is a function, it reads the files as left by any
+        earlier changes in the same commit.
+
+        Return a Future of the sha of the commit that includes the change."""
+
+        future = Future()
+        key = (repo, branch)
+
+        with self._mutex:
+            batch = self._batches.setdefault(key, [])
+            batch.append((file_descriptions, commit_message, future))
+
+            pending = len(batch)
+
+            if key not in self._timers and pending < self.max_changes:
+                timer = Timer(self.window, self._flush, args=key)
+                timer.daemon = True
+                self._timers[key] = timer
+                timer.start()
+
+        if pending >= self.max_changes:
+            self._flush(*key)
+
+        return future
 
-        matching_blobs = [el for el in base_tree.tree
-                          if el.type == 'blob' and
-                          el.path == filepath]
+    def flush(self):
+        """Commit everything that's pending now."""
+        for repo, branch in list(self._batches):
+            self._flush(repo, branch)
 
-        if not matching_blobs:
-            raise github.GithubException('File not found in repo.')
+    def _flush(self, repo, branch):
+        key = (repo, branch)
 
-        blob = gh_repo.get_git_blob(matching_blobs[0].sha)
+        with self._mutex:
+            batch = self._batches.pop(key, [])
+            timer = self._timers.pop(key, None)
+
+        if timer is not None:
+            timer.cancel()
+
+        if not batch:
+            return
+
+        def build(read):
+            #When several changes touch a path, the latest wins.
+            by_path = OrderedDict()
+
+            def read_through(path):
+                if path in by_path:
+                    return by_path[path].contents
+                return read(path)
+
+            for descs, _, _ in batch:
+                if callable(descs):
+                    descs = descs(read_through)
+
+                for desc in descs:
+                    by_path.pop(desc.path, None)
+                    by_path[desc.path] = desc
+
+            return by_path.values()
+
+        messages = [message for _, message, _ in batch]
+        if len(messages) == 1:
+            message = messages[0]
+        else:
+            message = '\n'.join(
+                ["group commit (%s changes)" % len(messages), ''] + messages)
 
-        if blob.encoding == 'base64':
-            return base64.b64decode(blob.content)
+        try:
+            sha = self.githubx.commit(repo=repo,
+                                      file_descriptions=build,
+                                      commit_message=message,
+                                      branch=branch)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
         else:
-            return blob.content
+            for _, _, future in batch:
+                future.set_result(sha)
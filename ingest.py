@@ -0,0 +1,224 @@
+"""A bounded, disk-backed queue for handling webhook posts off the request path.
+
+Several processes may share a spool directory: each keeps its items in its own
+subdirectory, which it holds a lock on. When a process starts, it takes over
+the items of any that have died."""
+
+import errno
+from glob import glob
+import json
+import logging
+import os
+import Queue
+import tempfile
+import threading
+import time
+import uuid
+
+from filelock import FileLock
+import metrics
+
+ITEMS = metrics.REGISTRY.counter(
+    'ingest_items_total', 'Queued items handled, by outcome.')
+RETRIES = metrics.REGISTRY.counter(
+    'ingest_retries_total', 'Failed attempts at handling an item.')
+QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'ingest_queue_depth', 'Items waiting to be handled.')
+
+
+class IngestQueue(object):
+    def __init__(self, spool_dir, handler,
+                 maxsize=100, workers=2, attempts=3, on_failure=None,
+                 logger=None):
+        """Queue items for handler(item), to be run by a pool of threads.
+
+        Each item is written to spool_dir before it's queued and removed once
+        handled, so items survive a restart. Items that fail ``attempts``
+        times are kept as ``*.failed`` for inspection.
+
+        :param spool_dir: a directory; created if needed.
+        :param handler: a callable taking one json-serializable item.
+        :param maxsize: the most items that may wait; put() refuses others.
+        :param on_failure: called with an item when it's given up on.
+        """
+
+        self.spool_dir = spool_dir
+        self.handler = handler
+        self.workers = workers
+        self.attempts = attempts
+        self.on_failure = on_failure
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._queue = Queue.Queue(maxsize)
+        self._threads = []
+        self._recovery = None
+
+        self._dir = None  # this process' subdirectory of spool_dir
+        self._dir_lock = None
+
+    def _ensure_spool(self):
+        if self._dir is not None:
+            return
+
+        try:
+            os.makedirs(self.spool_dir)
+        except OSError as exc:
+            if not (exc.errno == errno.EEXIST and os.path.isdir(self.spool_dir)):
+                raise
+
+        self._dir = tempfile.mkdtemp(prefix='%s-' % os.getpid(),
+                                     dir=self.spool_dir)
+        self._dir_lock = FileLock(os.path.join(self._dir, '.lock'))
+        self._dir_lock.acquire()
+
+    def close(self):
+        """Let another queue take over this one's spooled items, as if this
+        process had exited."""
+
+        if self._dir_lock is not None:
+            self._dir_lock.release()
+
+    def put(self, item):
+        """Persist and enqueue item without blocking.
+
+        Return False if the queue is full."""
+
+        if self._queue.full():
+            return False
+
+        self._ensure_spool()
+
+        #Timestamp first so a sorted listing is in arrival order.
+        name = "%.6f-%s.json" % (time.time(), uuid.uuid4().hex)
+        path = os.path.join(self._dir, name)
+
+        #Write then rename, so a crash never leaves a partial item.
+        with open(path + '.tmp', 'w') as f:
+            json.dump(item, f)
+        os.rename(path + '.tmp', path)
+
+        try:
+            self._queue.put_nowait(path)
+        except Queue.Full:
+            os.remove(path)
+            return False
+
+        return True
+
+    def qsize(self):
+        size = self._queue.qsize()
+        QUEUE_DEPTH.set(size)
+        return size
+
+    def join(self):
+        """Block until every queued item has been handled."""
+        if self._recovery is not None:
+            self._recovery.join()
+        self._queue.join()
+
+    def start(self):
+        """Start the workers, and requeue anything left in the spool by
+        processes that have exited."""
+
+        self._ensure_spool()
+
+        spooled = sorted(self._adopt_orphans(), key=os.path.basename)
+
+        #Recovered items may outnumber maxsize, so load them in the background.
+        self._recovery = threading.Thread(target=self._requeue,
+                                          args=(spooled,))
+        self._recovery.daemon = True
+        self._recovery.start()
+
+        for _ in range(self.workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _adopt_orphans(self):
+        """Move items of dead processes into our directory, and return the
+        paths of those that need handling."""
+
+        #Items spooled before there were subdirectories have no owner.
+        orphans = glob(os.path.join(self.spool_dir, '*.json'))
+
+        for path in glob(os.path.join(self.spool_dir, '*', '.lock')):
+            owner_dir = os.path.dirname(path)
+            if owner_dir == self._dir:
+                continue
+
+            lock = FileLock(path)
+            if not lock.acquire(blocking=False):
+                continue  # its process is alive
+
+            orphans.extend(glob(os.path.join(owner_dir, '*.json')))
+            for failed in glob(os.path.join(owner_dir, '*.failed')):
+                os.rename(failed,
+                          os.path.join(self._dir, os.path.basename(failed)))
+
+            os.remove(path)
+            lock.release()
+
+            try:
+                os.rmdir(owner_dir)
+            except OSError:
+                pass  # something was added meanwhile; it'll be adopted later
+
+        adopted = []
+        for path in orphans:
+            new_path = os.path.join(self._dir, os.path.basename(path))
+            try:
+                os.rename(path, new_path)
+            except OSError as exc:
+                #Another process adopted it first.
+                if exc.errno != errno.ENOENT:
+                    raise
+            else:
+                adopted.append(new_path)
+
+        return adopted
+
+    def _requeue(self, paths):
+        if paths:
+            self.logger.info("recovering %s spooled items", len(paths))
+
+        for path in paths:
+            self._queue.put(path)
+
+    def _work(self):
+        while True:
+            path = self._queue.get()
+            try:
+                self._handle(path)
+            except Exception:
+                #Eg an unreadable item. It's left in the spool for the next
+                #start to retry, and this thread goes on to the rest.
+                self.logger.exception("couldn't handle %s", path)
+                ITEMS.inc(outcome='error')
+            finally:
+                self._queue.task_done()
+
+    def _handle(self, path):
+        with open(path) as f:
+            item = json.load(f)
+
+        for attempt in range(1, self.attempts + 1):
+            try:
+                self.handler(item)
+            except Exception:
+                self.logger.exception("attempt %s of %s failed for %s",
+                                      attempt, self.attempts, path)
+                if attempt < self.attempts:
+                    RETRIES.inc()
+                    time.sleep(2 ** attempt)
+            else:
+                os.remove(path)
+                ITEMS.inc(outcome='ok')
+                return
+
+        os.rename(path, path + '.failed')
+        ITEMS.inc(outcome='failed')
+
+        if self.on_failure is not None:
+            self.on_failure(item)
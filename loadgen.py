@@ -0,0 +1,240 @@
+"""Load the webhook-to-commit pipeline, against the fakes in fakes.py.
+
+Signed webhooks are POSTed to a local tla server as fast as --concurrency
+allows; each post's latency is until a commit adding it lands::
+
+    python loadgen.py --posts 200 --concurrency 8 --latency 0.05
+
+With --processes, tla is served by gunicorn, as in production.
+
+Like bench.py, results can be saved as a baseline and compared with one::
+
+    python loadgen.py --posts 60 --latency 0.02 --compare loadgen_baseline.json
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from threading import Thread
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from werkzeug.serving import make_server
+
+from fakes import FakeContextIO, FakeGitHub, _QuietRequestHandler
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_gunicorn(processes, threads):
+    """Serve wsgi.py, with the current environment, and return
+    (process, url) once it's up."""
+
+    url = 'http://127.0.0.1:%s' % free_port()
+    server = subprocess.Popen(
+        ['gunicorn', 'wsgi:app', '--workers', str(processes),
+         '--threads', str(threads), '--bind', url[len('http://'):],
+         '--log-level', 'warning'])
+
+    for _ in range(100):
+        try:
+            requests.get(url + '/metrics')
+        except requests.ConnectionError:
+            time.sleep(0.1)
+        else:
+            return server, url
+
+    server.terminate()
+    raise Exception("gunicorn didn't start")
+
+
+def signed_webhook(account_id, message_id, secret, i):
+    """Return a webhook like the ones context.IO sends."""
+
+    timestamp = int(time.time())
+    token = 'loadgen-%s' % i
+
+    return {
+        'account_id': account_id,
+        'message_data': {'message_id': message_id},
+        'timestamp': timestamp,
+        'token': token,
+        'signature': hmac.new(secret, msg=str(timestamp) + token,
+                              digestmod=hashlib.sha256).hexdigest(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--posts', type=int, default=100,
+                        help='webhooks to send (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='webhooks in flight at once (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the fakes wait before each response '
+                             '(default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='serve with gunicorn, with this many worker '
+                             'processes (default: serve in this process)')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='threads per gunicorn worker '
+                             '(default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds to wait for every commit '
+                             '(default: %(default)s)')
+    parser.add_argument('--save', metavar='PATH',
+                        help='store results as a baseline')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='fail if slower than this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional slowdown when comparing '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    cio = FakeContextIO(latency=args.latency).start()
+    gh = FakeGitHub(latency=args.latency).start()
+    spool = tempfile.mkdtemp()
+
+    #tla reads these at import; the rest of its config comes from the env too,
+    #so e.g. INGEST_WORKERS and GROUP_COMMIT_WINDOW can be varied per run.
+    for key in ('GH_USER', 'GH_SECRET', 'CIO_KEY', 'CIO_SECRET', 'CIO_AID'):
+        os.environ.setdefault(key, 'loadgen')
+    os.environ.setdefault('LOG_SAMPLE_RATE', '0')
+    os.environ.update(CIO_BASE_URL=cio.url, GH_BASE_URL=gh.url,
+                      SPOOL_DIR=spool, DEDUP_PATH='')
+
+    import archive
+    import bench
+    from models import Post
+    import tla
+    tla.app.logger.setLevel(logging.INFO)
+
+    if args.processes:
+        gunicorn, url = start_gunicorn(args.processes, args.threads)
+        stop_server = gunicorn.terminate
+    else:
+        server = make_server('127.0.0.1', 0, tla.app, threaded=True,
+                             request_handler=_QuietRequestHandler)
+        server_thread = Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        url = 'http://127.0.0.1:%s' % server.server_port
+        stop_server = server.shutdown
+
+        tla.ingest_queue.start()
+
+    webhook_url = url + '/cio/webhook'
+
+    messages = bench.make_corpus(args.posts)
+    post_paths = []
+    for message in messages:
+        cio.add_message(message)
+        post_paths.append(
+            u'_posts/' + Post.from_cio_message(message).jekyll_fname()
+            .decode('utf-8'))
+
+    session = requests.Session()
+    sent_at = {}
+    response_seconds = []
+
+    def send(i):
+        webhook = signed_webhook(os.environ['CIO_AID'],
+                                 messages[i]['message_id'],
+                                 tla.app.config['CIO_SECRET'], i)
+        sent_at[post_paths[i]] = start = time.time()
+        response = session.post(webhook_url, json=webhook)
+        response_seconds.append(time.time() - start)
+        return response.status_code
+
+    start = time.time()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        statuses = list(pool.map(send, range(args.posts)))
+
+    committed_at = {}
+    while len(committed_at) < args.posts:
+        if time.time() - start > args.timeout:
+            break
+        time.sleep(0.05)
+        for updated_at, _, _, _, changed in list(gh.ref_updates):
+            for path in changed:
+                if path in sent_at and path not in committed_at:
+                    committed_at[path] = updated_at
+    elapsed = time.time() - start
+
+    commit_seconds = [committed_at[path] - sent_at[path]
+                      for path in committed_at]
+    index = gh.files('the-listserve-archive', 'gh-pages').get(
+        archive.INDEX_PATH)
+    indexed = json.loads(index)['count'] if index else 0
+
+    print "webhooks: %s sent, %s refused" % (
+        len(statuses), len([s for s in statuses if s != 200]))
+    print "posts: %s committed in %.2fs (%.1f posts/sec)" % (
+        len(committed_at), elapsed, len(committed_at) / elapsed)
+    print "commits: %s, conflicts: %s, github requests: %s" % (
+        len(gh.ref_updates), gh.conflicts, gh.requests)
+    for label, values in (('webhook response', response_seconds),
+                          ('webhook to commit', commit_seconds)):
+        if values:
+            print "%-18s p50 %.3fs  p99 %.3fs  max %.3fs" % (
+                label, percentile(values, .5), percentile(values, .99),
+                max(values))
+
+    print "index: %s posts" % indexed
+
+    cio.stop()
+    gh.stop()
+    stop_server()
+    shutil.rmtree(spool, ignore_errors=True)
+
+    if len(committed_at) < args.posts or indexed != args.posts:
+        print "FAILED: lost %s posts" % (args.posts - indexed)
+        sys.exit(1)
+
+    results = {'loadgen': {
+        'posts': args.posts,
+        'seconds': elapsed,
+        'posts_per_sec': len(committed_at) / elapsed,
+        'commits': len(gh.ref_updates),
+        'github_requests': gh.requests,
+        'commit_p99_seconds': percentile(commit_seconds, .99),
+    }}
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = bench.compare(results, json.load(f),
+                                        args.tolerance)
+
+        for regression in regressions:
+            print "REGRESSION", regression
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Githubx's commit and get_file, against local bare repositories.
+
+Commits are made with git plumbing, so bulk changes can be made at disk speed
+and then pushed to GitHub at once."""
+
+import os
+import shutil
+import subprocess
+import tempfile
+from threading import Lock
+
+import github
+
+import metrics
+
+COMMIT_SECONDS = metrics.REGISTRY.histogram(
+    'localgit_commit_seconds', 'Latency of commits to local repos.')
+
+ZERO_SHA = '0' * 40
+
+
+class GitError(Exception):
+    """Raised when a git command fails."""
+
+
+class LocalGitx(object):
+    def __init__(self, root, author=None):
+        """
+        :param root: the directory of the repos; the repo 'name' is the bare
+          repository root/name.git, as made by ``git clone --bare``.
+        :param author: a (name, email) pair for commits; by default, git's
+          configured user is used.
+        """
+
+        self.root = root
+        self.author = author
+
+        self._mutex = Lock()
+        self._readers = {}  # repo -> a running ``git cat-file --batch``
+
+    def _env(self, repo, env=None):
+        full_env = dict(os.environ, GIT_DIR=os.path.join(self.root,
+                                                         repo + '.git'))
+        if self.author is not None:
+            name, email = self.author
+            full_env.update(GIT_AUTHOR_NAME=name, GIT_AUTHOR_EMAIL=email,
+                            GIT_COMMITTER_NAME=name, GIT_COMMITTER_EMAIL=email)
+        full_env.update(env or {})
+        return full_env
+
+    def _git(self, repo, args, input=None, env=None, check=True):
+        """Run git in a repo and return its stdout, or None if it failed and
+        check is False."""
+
+        proc = subprocess.Popen(['git'] + list(args),
+                                env=self._env(repo, env),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate(input)
+
+        if proc.returncode != 0:
+            if check:
+                raise GitError("git %s: %s" % (' '.join(args), err.strip()))
+            return None
+
+        return out
+
+    def _head(self, repo, branch):
+        """Return the sha the branch points at, or None if it doesn't exist."""
+        out = self._git(repo, ['rev-parse', '--verify', '-q',
+                               'refs/heads/%s^{commit}' % branch], check=False)
+        return out.strip() if out else None
+
+    def commit(self, repo,
+               file_descriptions,
+               commit_message,
+               branch='master',
+               force=False,
+               attempts=5):
+        """Make a commit and return its sha, like Githubx.commit.
+
+        The branch is created if it doesn't exist. If nothing would change,
+        no commit is made and the head's sha is returned."""
+
+        with COMMIT_SECONDS.time():
+            for attempt in range(1, attempts + 1):
+                base_sha = self._head(repo, branch)
+
+                descs = file_descriptions
+                if callable(descs):
+                    descs = descs(lambda path: self._read(repo, base_sha, path))
+
+                new_sha = self._commit_tree(repo, base_sha, list(descs),
+                                            commit_message)
+                if new_sha == base_sha:
+                    return base_sha
+
+                #update-ref only moves the branch if it's still at base_sha.
+                update = ['update-ref', 'refs/heads/' + branch, new_sha]
+                if not force:
+                    update.append(base_sha or ZERO_SHA)
+
+                last_attempt = attempt == attempts
+                if self._git(repo, update, check=last_attempt) is not None:
+                    return new_sha
+
+    def _commit_tree(self, repo, base_sha, file_descriptions, commit_message):
+        """Write the objects of a commit on base_sha and return its sha."""
+
+        tmp_dir = tempfile.mkdtemp()
+
+        try:
+            #A private index, so concurrent commits don't share one.
+            env = {'GIT_INDEX_FILE': os.path.join(tmp_dir, 'index')}
+
+            if base_sha is None:
+                self._git(repo, ['read-tree', '--empty'], env=env)
+            else:
+                self._git(repo, ['read-tree', base_sha], env=env)
+
+            blob_paths = []
+            for i, desc in enumerate(file_descriptions):
+                contents = desc.contents
+                if isinstance(contents, unicode):
+                    contents = contents.encode('utf-8')
+
+                blob_paths.append(os.path.join(tmp_dir, str(i)))
+                with open(blob_paths[-1], 'wb') as f:
+                    f.write(contents)
+
+            blob_shas = self._git(repo, ['hash-object', '-w', '--stdin-paths'],
+                                  input='\n'.join(blob_paths) + '\n',
+                                  env=env).split() if blob_paths else []
+
+            index_info = ''.join(
+                '%s %s\t%s\n' % ('100755' if desc.executable else '100644',
+                                 sha, desc.path)
+                for desc, sha in zip(file_descriptions, blob_shas))
+            self._git(repo, ['update-index', '--index-info'],
+                      input=index_info, env=env)
+
+            tree_sha = self._git(repo, ['write-tree'], env=env).strip()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        if base_sha is not None and tree_sha == self._git(
+                repo, ['rev-parse', base_sha + '^{tree}']).strip():
+            #Nothing changed; don't make an empty commit.
+            return base_sha
+
+        parents = ['-p', base_sha] if base_sha is not None else []
+        return self._git(repo, ['commit-tree', tree_sha] + parents,
+                         input=commit_message).strip()
+
+    def get_file(self, repo, filepath, branch='master'):
+        """Return the file contents, like Githubx.get_file."""
+
+        contents = None
+
+        head_sha = self._head(repo, branch)
+        if head_sha is not None:
+            contents = self._read(repo, head_sha, filepath)
+
+        if contents is None:
+            raise github.UnknownObjectException(
+                404, {'message': 'File not found in repo.'})
+
+        return contents
+
+    def _read(self, repo, commit_sha, filepath):
+        """Return the contents of a file at a commit, or None."""
+
+        if commit_sha is None:
+            return None
+
+        #One long-running process answers every read, rather than one each.
+        with self._mutex:
+            reader = self._readers.get(repo)
+            if reader is None:
+                reader = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                          env=self._env(repo),
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE)
+                self._readers[repo] = reader
+
+            reader.stdin.write('%s:%s\n' % (commit_sha, filepath))
+            reader.stdin.flush()
+
+            #"<sha> <type> <size>", or "<name> missing".
+            header = reader.stdout.readline().split()
+            if header[-1] == 'missing':
+                return None
+
+            contents = reader.stdout.read(int(header[2]))
+            reader.stdout.read(1)  # the trailing newline
+
+        if header[1] != 'blob':
+            return None
+
+        return contents
+
+    def close(self):
+        """Stop the reader processes."""
+        with self._mutex:
+            for reader in self._readers.values():
+                reader.stdin.close()
+                reader.wait()
+            self._readers.clear()
+
+    def push(self, repo, branch='master', remote='origin', force=False):
+        """Push a branch to a remote of the repo."""
+
+        refspec = 'refs/heads/%s:refs/heads/%s' % (branch, branch)
+        if force:
+            refspec = '+' + refspec
+
+        self._git(repo, ['push', remote, refspec])
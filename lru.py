@@ -0,0 +1,42 @@
+"""A small, thread-safe least-recently-used cache."""
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._mutex = Lock()
+
+    def get(self, key, default=None):
+        with self._mutex:
+            if key not in self._data:
+                return default
+
+            #Re-insert to mark as most recently used.
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._mutex:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def keys(self):
+        """Return the keys, least recently used first."""
+        with self._mutex:
+            return list(self._data)
+
+    def __contains__(self, key):
+        with self._mutex:
+            return key in self._data
+
+    def __len__(self):
+        with self._mutex:
+            return len(self._data)
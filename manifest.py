@@ -0,0 +1,108 @@
+"""Records which outputs each render unit produced, for incremental rebuilds.
+
+A unit is a group of sources rendered together, eg a month of posts."""
+
+import hashlib
+import json
+import os
+
+
+def content_hash(contents):
+    """Return a hex digest of a (unicode or byte) string."""
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+    return hashlib.sha1(contents).hexdigest()
+
+
+class Manifest(object):
+    def __init__(self, path):
+        """Load the manifest at path, or start an empty one."""
+
+        self.path = path
+
+        #unit -> {'renderer': version, 'outputs': {path: hash},
+        #         'sources': {path: {'stat': [mtime, size], 'hash': hash}}}
+        self.units = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.units = json.load(f)
+
+    def _stat(self, source):
+        st = os.stat(source)
+        return [st.st_mtime, st.st_size]
+
+    def is_fresh(self, unit, renderer, sources):
+        """Return True if unit's outputs are up to date.
+
+        Outputs also go stale if the unit's sources aren't the same ones.
+
+        Sources are only read if their mtime or size have changed."""
+
+        entry = self.units.get(unit)
+
+        if (entry is None or entry.get('renderer') != renderer or
+                sorted(entry.get('sources', ())) != sorted(sources)):
+            return False
+
+        if not all(os.path.exists(out) for out in entry['outputs']):
+            return False
+
+        for source in sources:
+            recorded = entry['sources'][source]
+            stat = self._stat(source)
+            if stat == recorded['stat']:
+                continue
+
+            #Touched, but maybe not changed.
+            with open(source, 'rb') as f:
+                if content_hash(f.read()) != recorded['hash']:
+                    return False
+
+            recorded['stat'] = stat
+
+        return True
+
+    def output_hash(self, unit, output):
+        """Return the recorded hash of an output, or None."""
+        entry = self.units.get(unit)
+        return entry and entry['outputs'].get(output)
+
+    def record(self, unit, renderer, sources, outputs):
+        """Record the outputs of rendering unit's sources.
+
+        :param outputs: a dict of {path: content hash}.
+        """
+
+        recorded = {}
+        for source in sources:
+            with open(source, 'rb') as f:
+                recorded[source] = {'stat': self._stat(source),
+                                    'hash': content_hash(f.read())}
+
+        self.units[unit] = {
+            'renderer': renderer,
+            'sources': recorded,
+            'outputs': outputs,
+        }
+
+    def forget_except(self, units):
+        """Drop entries for anything not in units.
+
+        That includes entries of the old per-source format, so a rebuild
+        after upgrading redoes everything but still removes stale outputs."""
+        units = set(units)
+        for unit in list(self.units):
+            if unit not in units:
+                del self.units[unit]
+
+    def outputs(self):
+        """Return the set of every recorded output."""
+        return set(out
+                   for entry in self.units.values()
+                   for out in entry['outputs'])
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.units, f, indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
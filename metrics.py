@@ -0,0 +1,268 @@
+"""In-process counters and histograms, exposed in the Prometheus text format.
+
+Processes serving the same app (eg gunicorn workers) can share their values
+through a directory, so each of them exposes the totals; see Registry.share.
+
+See https://prometheus.io/docs/instrumenting/exposition_formats/."""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import errno
+from glob import glob
+import json
+import os
+from threading import Lock, Thread
+import time
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in labels)
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._mutex = Lock()
+        self._values = {}  # sorted label tuple -> value
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def values(self):
+        """Return a copy of the values, as {label tuple: value}."""
+        with self._mutex:
+            return dict((key, self._copy(value))
+                        for key, value in self._values.items())
+
+    def _copy(self, value):
+        return value
+
+    def merge(self, value, other):
+        """Return the value of two processes' samples combined."""
+        return value + other
+
+    def exposition(self, values=None):
+        """Return the lines of the metric in the text format.
+
+        :param values: what to expose instead of this process's values.
+        """
+
+        if values is None:
+            values = self.values()
+
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+
+        for key in sorted(values):
+            lines.extend(self._sample_lines(key, values[key]))
+
+        return lines
+
+    def _sample_lines(self, key, value):
+        return ['%s%s %s' % (self.name, _format_labels(key),
+                             _format_value(value))]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._mutex:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, merge=sum):
+        """:param merge: combines processes' values, given a list of them."""
+        super(Gauge, self).__init__(name, help)
+        self._merge = merge
+
+    def merge(self, value, other):
+        return self._merge([value, other])
+
+    def set(self, value, **labels):
+        with self._mutex:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._mutex:
+            #[per-bucket counts, count, sum]
+            entry = self._values.setdefault(
+                key, [[0] * len(self.buckets), 0, 0.0])
+
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def _copy(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+    def merge(self, value, other):
+        return [[a + b for a, b in zip(value[0], other[0])],
+                value[1] + other[1],
+                value[2] + other[2]]
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with block, even if it raises."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _sample_lines(self, key, value):
+        counts, count, total = value
+        lines = []
+
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = key + (('le', _format_value(bound)),)
+            lines.append('%s_bucket%s %s' % (self.name, _format_labels(labels),
+                                             cumulative))
+
+        lines.append('%s_sum%s %s' % (self.name, _format_labels(key),
+                                      _format_value(total)))
+        lines.append('%s_count%s %s' % (self.name, _format_labels(key), count))
+
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+        self._directory = None  # see share()
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help, merge=sum):
+        return self._add(Gauge(name, help, merge))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def share(self, directory, interval=5.0):
+        """Expose the totals of every process sharing directory.
+
+        This process's values are written to directory every interval
+        seconds, and before each exposition, which reads every process's.
+        Counters and histograms of processes that have exited still count;
+        their gauges don't."""
+
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+        self._directory = directory
+
+        def write_periodically():
+            while True:
+                time.sleep(interval)
+                self._write_snapshot()
+
+        thread = Thread(target=write_periodically)
+        thread.daemon = True
+        thread.start()
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self._directory, '%s.json' % pid)
+
+    def _write_snapshot(self):
+        snapshot = dict((metric.name, metric.values().items())
+                        for metric in self._metrics)
+
+        path = self._snapshot_path(os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(path + '.tmp', path)
+
+    def _shared_values(self):
+        """Return {metric name: values} totalled over every process."""
+
+        self._write_snapshot()
+
+        totals = dict((metric.name, {}) for metric in self._metrics)
+        metrics = dict((metric.name, metric) for metric in self._metrics)
+
+        for path in glob(self._snapshot_path('*')):
+            pid = int(os.path.basename(path).split('.')[0])
+
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (IOError, ValueError):
+                #Removed or half-written by its process; it'll be back.
+                continue
+
+            alive = _is_alive(pid)
+
+            for name, values in snapshot.items():
+                metric = metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not alive):
+                    continue
+
+                total = totals[name]
+                for key, value in values:
+                    key = tuple(tuple(pair) for pair in key)
+                    if key in total:
+                        value = metric.merge(total[key], value)
+                    total[key] = value
+
+        return totals
+
+    def exposition(self):
+        """Return every metric in the Prometheus text format."""
+
+        totals = {}
+        if self._directory is not None:
+            totals = self._shared_values()
+
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.exposition(totals.get(metric.name)))
+        return '\n'.join(lines) + '\n'
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+REGISTRY = Registry()
+
+EXPOSITION_CONTENT_TYPE = 'text/plain; version=0.0.4'
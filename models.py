@@ -1,37 +1,165 @@
 import cgi
 from collections import namedtuple
 import datetime
+import email.errors
+from email.header import decode_header, make_header
+import email.utils
+import io
 
 import pytz
 from slugify import slugify
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+#Wider than any string, so none are folded; see dump_yaml.
+YAML_WIDTH = 2 ** 31 - 1
+
+#The frontmatter of postjson and postmulti files, as SafeDumper would dump it;
+#their schemas are fixed, so templates are much faster.
+#Datekeys look like yaml timestamps, so they're quoted.
+POSTJSON_FRONTMATTER = "datekey: '{datekey}'\nlayout: postjson\n"
+POSTMULTI_FRONTMATTER = ("canonical_datekey: '{canonical_datekey}'\n"
+                         "datekey: '{datekey}'\n"
+                         "layout: postmulti\n")
+
+
+def strip_footer(body):
+    """Return a post body without the unsubscribe text the list appends."""
+    return body[:body.rfind('--')]
+
+
+def post_date(timestamp):
+    """Return the (year, month, day) of a post sent at timestamp."""
+
+    date = datetime.datetime.fromtimestamp(timestamp)
+    #This is a hack. Apparently, the posts aren't sent out automatically,
+    # but manually sent on a schedule aligned with EST.
+    #Convert to EST and allow for a few hours of
+    # leeway past midnight.
+    eastern = pytz.timezone("US/Eastern")
+    date = eastern.localize(date)
+    date = date - datetime.timedelta(hours=4)
+    return (date.year, date.month, date.day)
+
+
+def _decode(bytestring, charset):
+    try:
+        return bytestring.decode(charset or 'us-ascii', 'replace')
+    except LookupError:
+        #An unknown charset.
+        return bytestring.decode('latin-1')
+
+
+def _decode_header(value):
+    """Return a header value as unicode, decoding RFC 2047 encoded words."""
+    try:
+        return unicode(make_header(decode_header(value)))
+    except (LookupError, UnicodeError, email.errors.HeaderParseError):
+        return _decode(value, 'utf-8')
+
+
+def _plain_text(message):
+    """Return the first text/plain part of an email as unicode, or None."""
+
+    for part in message.walk():
+        if (part.get_content_type() == 'text/plain' and
+                not part.get_filename()):
+            payload = part.get_payload(decode=True) or ''
+            return _decode(payload, part.get_content_charset())
+
+    return None
+
 
 def property_escape(s, encode_quote=False):
     """Return an ascii string with xml charrefs."""
     return cgi.escape(s, encode_quote).encode('ascii', 'xmlcharrefreplace')
 
 
-def jekyll_file_contents(frontmatter=None, contents=None):
+def dump_yaml(data):
+    """Return a bytestring of block-style yaml, like yaml.safe_dump.
+
+    It's dumped with libyaml when it's available. Long strings aren't folded,
+    since libyaml folds them at different places than PyYAML does; the output
+    is the same with either."""
+
+    # default_flow_style=False will always dump in block format,
+    #  which looks more natural in jekyll files.
+    return yaml.dump(data, Dumper=SafeDumper, default_flow_style=False,
+                     width=YAML_WIDTH, allow_unicode=False)
+
+
+def jekyll_file_contents(frontmatter=None, contents=None,
+                         frontmatter_yaml=None):
     """Return a bytestring of jekyll file contents.
 
     :param fontmatter: a dict
     :param content: a string
+    :param frontmatter_yaml: frontmatter that's already dumped, instead
     """
 
-    if frontmatter is None:
-        frontmatter = {'layout': 'nil'}
+    if frontmatter_yaml is None:
+        if frontmatter is None:
+            frontmatter = {'layout': 'nil'}
+        frontmatter_yaml = dump_yaml(frontmatter)
     if contents is None:
         contents = ''
 
-    # default_flow_style=False will always dump in block format,
-    #  which looks more natural in jekyll files.
     return '\n'.join(['---',
-                      yaml.safe_dump(frontmatter, default_flow_style=False),
+                      frontmatter_yaml,
                       '---',
                       contents])
 
 
+def read_frontmatter(path):
+    """Return the yaml frontmatter of a jekyll file as a dict.
+
+    The file is only read up to the closing '---', and is parsed with libyaml
+    when it's available."""
+
+    with io.open(path, 'r', encoding='utf-8') as f:
+        return _load_frontmatter(f, path)
+
+
+def parse_frontmatter(contents):
+    """Return the yaml frontmatter of jekyll file contents as a dict."""
+    return _load_frontmatter(contents.splitlines(True), 'contents')
+
+
+def _load_frontmatter(lines, name):
+    lines = iter(lines)
+    if next(lines, '').rstrip('\r\n') != '---':
+        raise ValueError("%s has no frontmatter" % name)
+
+    frontmatter = []
+    for line in lines:
+        if line.rstrip('\r\n') == '---':
+            break
+        frontmatter.append(line)
+    else:
+        raise ValueError("%s has unterminated frontmatter" % name)
+
+    return yaml.load(''.join(frontmatter), Loader=SafeLoader)
+
+
+def day_index_contents(entries):
+    """Return a bytestring of yaml for a list of Post.day_index_entry()s."""
+    return dump_yaml(entries)
+
+
+def read_day_index(contents):
+    """Return the list of entries in day_index_contents output."""
+    return yaml.load(contents, Loader=SafeLoader) or []
+
+
+def body_include(fname):
+    """Return the name of the include holding the html of _posts/fname."""
+    return 'posts/' + fname
+
+
 class Post(namedtuple('Post', ['subject', 'author', 'body', 'date'])):
     """Represents a single Listserve email post.
 
@@ -67,18 +195,35 @@ class Post(namedtuple('Post', ['subject', 'author', 'body', 'date'])):
         author = m_from['name'] if 'name' in m_from else 'Anonymous'
 
         body = message['body'][0]['content']  # TL sends one plaintext body.
-        #Remove unsubscribe text.
-        body = body[:body.rfind('--')]
-
-        date = datetime.datetime.fromtimestamp(message['date'])
-        #This is a hack. Apparently, the posts aren't sent out automatically,
-        # but manually sent on a schedule aligned with EST.
-        #Convert to EST and allow for a few hours of
-        # leeway past midnight.
-        eastern = pytz.timezone("US/Eastern")
-        date = eastern.localize(date)
-        date = date - datetime.timedelta(hours=4)
-        date = (date.year, date.month, date.day)
+        body = strip_footer(body)
+
+        date = post_date(message['date'])
+
+        return Post(subject, author, body, date)
+
+    @staticmethod
+    def from_email(message):
+        """Post factory from an email.message.Message, eg from an mbox.
+
+        The same rules as from_cio_message apply. Raise ValueError if the
+        message has no date or plain text body."""
+
+        subject = _decode_header(message.get('subject', ''))
+
+        name, _ = email.utils.parseaddr(message.get('from', ''))
+        author = _decode_header(name) if name else 'Anonymous'
+
+        body = _plain_text(message)
+        if body is None:
+            raise ValueError("no text/plain part")
+        #Context.IO gave bodies as sent: with CRLFs.
+        body = body.replace('\r\n', '\n').replace('\n', '\r\n')
+        body = strip_footer(body)
+
+        parsed_date = email.utils.parsedate_tz(message.get('date', ''))
+        if parsed_date is None:
+            raise ValueError("no valid Date header")
+        date = post_date(email.utils.mktime_tz(parsed_date))
 
         return Post(subject, author, body, date)
 
@@ -109,12 +254,9 @@ class Post(namedtuple('Post', ['subject', 'author', 'body', 'date'])):
 
         It will render to a json representation of this post."""
 
-        frontmatter = {
-            'layout': 'postjson',
-            'datekey': self.datestr(),
-        }
+        frontmatter_yaml = POSTJSON_FRONTMATTER.format(datekey=self.datestr())
 
-        return jekyll_file_contents(frontmatter=frontmatter)
+        return jekyll_file_contents(frontmatter_yaml=frontmatter_yaml)
 
     def to_jekyll_multipost(self):
         """Return the body of a Jekyll stand-alone html file.
@@ -123,55 +265,116 @@ class Post(namedtuple('Post', ['subject', 'author', 'body', 'date'])):
         Otherwise it will just render the post.
         """
 
-        frontmatter = {
-            'layout': 'postmulti',
-            'datekey': self.datestr(),
-            'canonical_datekey': self.datestr(),
-        }
+        frontmatter_yaml = POSTMULTI_FRONTMATTER.format(
+            datekey=self.datestr(),
+            canonical_datekey=self.datestr())
+
+        return jekyll_file_contents(frontmatter_yaml=frontmatter_yaml)
+
+    def page_title(self):
+        """Return the subject, as used for page titles."""
+        page_title = self.subject.replace('[The Listserve]', '').strip()
+        return page_title or '[no subject]'
+
+    def jekyll_fname(self, n=1):
+        """Return the filename of this Post in _posts.
+
+        n > 1 gives the nth post on the same day with the same title a
+        filename of its own."""
+
+        page_title = slugify(self.page_title()).encode('utf-8')
+        if n > 1:
+            page_title += '-%s' % n
 
-        return jekyll_file_contents(frontmatter=frontmatter)
+        #Jekyll needs the filename as YYYY-MM-DD-title.markup
+        #title can be empty, but we still need the '-'
+        return "{date}-{page_title}.html".format(
+            date=self.datestr(),
+            page_title=page_title
+        )
+
+    def api_data(self, body_html=True):
+        """Return a dict of this Post's data, as rendered by the layouts.
 
-    def to_jekyll_html(self):
-        """Return a Jekyll post as (filename, contents)."""
+        :param body_html: include the html of the body.
+        """
 
         date = datetime.date(*self.date)
         full_month_datestr = date.strftime("%B %d %Y")  # eg 'August 02 2012'
         datestr_with_comma = date.strftime("%B %d, %Y")
 
         #The post subject becomes the page title and description.
-        page_title = self.subject.replace('[The Listserve]', '').strip()
-        if not page_title:
-            page_title = '[no subject]'
-            desc_title = page_title
-        else:
+        page_title = self.page_title()
+        if page_title == self.subject.replace('[The Listserve]', '').strip():
             desc_title = '"%s"' % page_title
+        else:
+            desc_title = page_title
 
         desc = "The Listserve post on %s: %s" % (datestr_with_comma, desc_title)
 
-        #Jekyll needs the filename as YYYY-MM-DD-title.markup
-        #title can be empty, but we still need the '-'
-        fname = "{date}-{page_title}.html".format(
-            date=self.datestr(),
-            page_title=slugify(page_title).encode('utf-8')
-        )
+        api_data = {
+            'post': dict(self._asdict()),  # yaml can't encode an OrderedDict
+            'post_html': {
+                #TODO do we really need to encode quotes here?
+                'title': property_escape(page_title, True),
+                'desc': property_escape(desc, True),
+                'date': full_month_datestr,
+            }
+        }
+
+        if body_html:
+            api_data['post_html']['body'] = self.body_as_html()
+
+        return api_data
+
+    def day_index_entry(self, fname=None):
+        """Return this Post's entry in the index of its day's posts.
+
+        It's what the postjson and postmulti layouts render, but for the html
+        of the body, which is only stored in the include named body_include.
+
+        :param fname: the filename, if not jekyll_fname().
+        """
+
+        if fname is None:
+            fname = self.jekyll_fname()
+
+        entry = self.api_data(body_html=False)
+        entry.update(file=fname, title=self.page_title(),
+                     body_include=body_include(fname))
+
+        return entry
+
+    def to_jekyll_html(self, fname=None, html_include=False):
+        """Return a Jekyll post as (filename, contents).
+
+        The html of the body is in the frontmatter, unless html_include is
+        set; then the post layout includes it from body_include(filename),
+        and it's only stored there (see to_jekyll_include).
+
+        :param fname: the filename, if not jekyll_fname().
+        """
+
+        if fname is None:
+            fname = self.jekyll_fname()
 
         frontmatter = {
             'layout': 'post',
-            'tags': [self.datestr()],  # a hack to build {datestr => [posts]} globally
-            'title': page_title,
-            'api_data': {
-                'post': dict(self._asdict()),  # yaml can't encode an OrderedDict
-                'post_html': {
-                    'body': self.body_as_html(),
-                    #TODO do we really need to encode quotes here?
-                    'title': property_escape(page_title, True),
-                    'desc': property_escape(desc, True),
-                    'date': full_month_datestr,
-                }
-            }
+            'title': self.page_title(),
+            'api_data': self.api_data(body_html=not html_include),
         }
 
+        if html_include:
+            frontmatter['body_include'] = body_include(fname)
+
         # yaml dumps a bytestring
         contents = jekyll_file_contents(frontmatter=frontmatter)
 
         return (fname, contents)
+
+    def to_jekyll_include(self):
+        """Return the html of the body, as the contents of a Jekyll include.
+
+        Includes are rendered by Liquid, so braces are escaped."""
+        html = self.body_as_html()
+        return html.replace('{', '&#123;').replace('}', '&#125;')
@@ -0,0 +1,130 @@
+"""A request budget for a rate-limited API, shared by every thread.
+
+The budget is learned from the API's responses (eg GitHub's X-RateLimit-*
+headers), so it accounts for every client using the same credentials.
+
+Live calls, like committing a post as it arrives, may spend all of it.
+Bulk calls, like backfills, are paced to spread what's left above a reserve
+over the rest of the window, so they finish as soon as the quota allows
+without leaving live calls nothing."""
+
+from threading import Condition
+import time
+
+import metrics
+
+LIVE = 'live'
+BULK = 'bulk'
+
+WAIT_SECONDS = metrics.REGISTRY.histogram(
+    'ratelimit_wait_seconds',
+    'Time calls waited for rate limit budget, by priority.')
+REMAINING = metrics.REGISTRY.gauge(
+    'ratelimit_remaining', 'Requests left in the rate limit window.',
+    merge=min)  # processes share the budget
+
+
+class RateLimiter(object):
+    def __init__(self, reserve=500, burst=10, retry_after=60):
+        """
+        :param reserve: requests bulk calls leave for live ones.
+        :param burst: how many bulk calls may be made at once after a lull.
+        :param retry_after: seconds to wait when the quota ran out and the
+          API didn't say when it resets.
+        """
+
+        self.reserve = reserve
+        self.burst = burst
+        self.retry_after = retry_after
+
+        self._cond = Condition()
+        self._remaining = None  # unknown until a response says
+        self._reset = 0  # when the window ends, as a timestamp
+        self._tokens = float(burst)  # for bulk calls
+        self._refilled = time.time()
+        self._live_waiting = 0
+
+    def update(self, remaining, reset):
+        """Record the budget a response reported."""
+
+        with self._cond:
+            self._remaining = remaining
+            self._reset = reset
+            REMAINING.set(remaining)
+            self._cond.notify_all()
+
+    def exhausted(self):
+        """Record that a call was refused for being over the limit."""
+
+        with self._cond:
+            now = time.time()
+            self._remaining = 0
+            if self._reset <= now:
+                self._reset = now + self.retry_after
+            REMAINING.set(0)
+
+    def acquire(self, priority=LIVE):
+        """Block until a call of this priority may be made."""
+
+        start = time.time()
+
+        with self._cond:
+            if priority == LIVE:
+                self._live_waiting += 1
+
+            try:
+                while True:
+                    delay = self._delay(priority, time.time())
+                    if delay is not None and delay <= 0:
+                        break
+                    self._cond.wait(delay)
+            finally:
+                if priority == LIVE:
+                    self._live_waiting -= 1
+                    self._cond.notify_all()
+
+            if self._remaining is not None:
+                self._remaining -= 1
+            if priority == BULK:
+                self._tokens -= 1
+
+        WAIT_SECONDS.observe(time.time() - start, priority=priority)
+
+    def _delay(self, priority, now):
+        """Return how long a call must wait, or None to wait for a notify.
+
+        Only call this holding self._cond."""
+
+        if self._remaining is not None and now >= self._reset:
+            #A new window; the next response will say what's left of it.
+            self._remaining = None
+
+        #Bulk calls are paced at what's spare over the rest of the window.
+        if self._remaining is None:
+            rate = None
+        else:
+            spare = self._remaining - self.reserve
+            rate = max(spare, 0) / max(self._reset - now, 1.0)
+
+        if rate is None:
+            self._tokens = float(self.burst)
+        else:
+            self._tokens = min(self.burst,
+                               self._tokens + rate * (now - self._refilled))
+        self._refilled = now
+
+        if priority == LIVE:
+            if self._remaining is None or self._remaining > 0:
+                return 0
+            return self._reset - now
+
+        if self._live_waiting:
+            return None
+
+        if self._tokens >= 1:
+            return 0
+
+        if not rate:
+            return self._reset - now
+
+        return (1 - self._tokens) / rate
@@ -103,3 +103,43 @@ cio_email = {
    u"subject":u"subject"
 }
 
+
+#Posts whose files_to_create output is kept in golden/<name>/. It's the same
+#with libyaml's emitter and PyYAML's pure-Python one.
+golden_posts = {
+    'plain': {
+        u'subject': u'[The Listserve] Hello, world',
+        u'author': u'Jane Doe',
+        u'body': u'First paragraph,\r\nwith a second line.\r\n\r\nSecond one.',
+        u'date': [2012, 9, 4],
+    },
+    'unicode': {
+        u'subject': u'[The Listserve] Caf\xe9 \u2603 \u4e16\u754c \U0001f642',
+        u'author': u'Bj\xf6rk Gu\xf0mundsd\xf3ttir',
+        u'body': (u'\u201cQuoted\u201d \u2014 na\xefve fa\xe7ade\r\n\r\n'
+                  u'\u041f\u0440\u0438\u0432\u0435\u0442 \u043c\u0438\u0440 '
+                  u'\u3053\u3093\u306b\u3061\u306f \u2026'),
+        u'date': [2013, 2, 28],
+    },
+    'yaml_special': {
+        u'subject': u'- key: value # \'single\' "double" & *alias !tag',
+        u'author': u'@someone: %s',
+        u'body': (u'---\r\nkey: value\r\n\r\n\t- tabbed\r\n'
+                  u'<b>html & entities</b> {braces} [brackets] | > ? yes no'),
+        u'date': [2013, 12, 31],
+    },
+    'empty': {
+        u'subject': u'[The Listserve]',
+        u'author': u'',
+        u'body': u'',
+        u'date': [2014, 1, 1],
+    },
+    'long_lines': {
+        u'subject': u'[The Listserve] ' + u'a long subject ' * 8,
+        u'author': u'Author',
+        u'body': (u'x' * 300 + u'\r\n\r\n' +
+                  u' '.join([u'word'] * 200) + u'\r\n' +
+                  u'trailing spaces   \r\n   leading spaces'),
+        u'date': [2012, 10, 1],
+    },
+}
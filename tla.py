@@ -1,52 +1,203 @@
+import functools
 import hmac
 import hashlib
+import json
 import os
+import random
+from threading import Lock, Thread
 
-from flask import Flask, request
-from rauth import OAuth1Session
+from flask import Flask, Response, request
 
-from githubx import Githubx, file_description
-from models import Post
+from dedup import Deduplicator
+from filelock import FileLock
+from ingest import IngestQueue
+import metrics
 
+#The GitHub and Context.IO clients, and models (with yaml), aren't needed to
+#accept a webhook, so they're imported on first use to keep cold starts fast.
+#See bench_startup.py.
+
+
+#Bump this when files_to_create output changes, so rebuilds redo every post.
+#See renderer_version().
+RENDERER_VERSION = 7
+
+ARCHIVE_REPO = 'the-listserve-archive'
+SITE_BRANCH = 'gh-pages'  # what GitHub Pages publishes
 
 ENV_KEYS = ('GH_USER', 'GH_SECRET', 'CIO_KEY', 'CIO_SECRET')
 
+#Optional env keys; values are converted to the type of their default.
+ENV_DEFAULTS = {
+    'SPOOL_DIR': 'spool',
+    'INGEST_WORKERS': 2,
+    'INGEST_QUEUE_SIZE': 100,
+    'GROUP_COMMIT_WINDOW': 0.0,  # seconds; 0 commits each post alone
+    'GROUP_COMMIT_MAX_CHANGES': 10,
+    'LOG_SAMPLE_RATE': 0.01,  # fraction of request payloads to log
+    'HTTP_POOL_SIZE': 10,
+    'HTTP_CONNECT_TIMEOUT': 5.0,  # seconds
+    'HTTP_READ_TIMEOUT': 30.0,
+    'HTTP_RETRIES': 3,
+    'DEDUP_SIZE': 10000,  # handled messages and posts to remember
+    'DEDUP_PATH': 'seen.log',  # '' to only remember in memory
+    'CIO_BASE_URL': 'https://api.context.io',  # see fakes.py
+    'GH_BASE_URL': 'https://api.github.com',
+    'COMMIT_LOCK_PATH': '',  # processes sharing it take turns committing
+    'GH_RATE_LIMIT_RESERVE': 500,  # requests backfills leave for live posts
+    'METRICS_DIR': 'metrics',  # see wsgi.py
+    'POST_HTML_INCLUDES': 0,  # 1 once gh-pages' post layout includes bodies
+}
+
+STAGE_SECONDS = metrics.REGISTRY.histogram(
+    'tla_stage_seconds', 'Latency of each stage of handling a post.')
+POSTS = metrics.REGISTRY.counter(
+    'tla_posts_total', 'Posts committed.')
+DUPLICATES = metrics.REGISTRY.counter(
+    'tla_duplicates_total', 'Redelivered messages and posts skipped, by kind.')
+
 app = Flask(__name__)
-app.debug = True
 
 
-def load_env_conf(keys=ENV_KEYS):
-    """A hack, since I'm using Heroku env files + foreman."""
+def load_env_conf(keys=ENV_KEYS, defaults=ENV_DEFAULTS):
+    """A hack, since I'm using Heroku env files + foreman.
+
+    Missing keys are left unset, so they only fail where they're used."""
     global app
     for key in keys:
-        app.config[key] = os.environ[key]
+        if key in os.environ:
+            app.config[key] = os.environ[key]
+        else:
+            app.logger.warning("%s is not set", key)
+    for key, default in defaults.items():
+        app.config[key] = type(default)(os.environ.get(key, default))
 
 load_env_conf()
 
 
-cio_requests = OAuth1Session(os.environ['CIO_KEY'], os.environ['CIO_SECRET'])
+def _once(factory):
+    """Decorate a function to only be run on its first call; later calls
+    return the same result."""
+
+    mutex = Lock()
+    result = []
+
+    @functools.wraps(factory)
+    def get():
+        with mutex:
+            if not result:
+                result.append(factory())
+        return result[0]
+
+    return get
+
+
+def renderer_version():
+    """Return what rebuilds record as the version of files_to_create, which
+    also depends on POST_HTML_INCLUDES."""
+
+    if app.config['POST_HTML_INCLUDES']:
+        return '%s-includes' % RENDERER_VERSION
+    return RENDERER_VERSION
+
+
+def make_transport(name):
+    """Return a Transport configured from app.config."""
+    from transport import Transport
+
+    return Transport(name,
+                     pool_size=app.config['HTTP_POOL_SIZE'],
+                     connect_timeout=app.config['HTTP_CONNECT_TIMEOUT'],
+                     read_timeout=app.config['HTTP_READ_TIMEOUT'],
+                     retries=app.config['HTTP_RETRIES'])
+
+
+@_once
+def cio_requests():
+    """Return the requests Session for Context.IO."""
+    from rauth import OAuth1Session
+
+    return make_transport('contextio').mount(
+        OAuth1Session(app.config['CIO_KEY'], app.config['CIO_SECRET']))
+
+
+@_once
+def githubx():
+    """Return the Githubx for the archive."""
+    from githubx import Githubx
+    from ratelimit import RateLimiter
+
+    return Githubx(
+        app.config['GH_USER'],
+        app.config['GH_SECRET'],
+        user_agent='github.com/simon-weber/the-listserve-archive',
+        base_url=app.config['GH_BASE_URL'],
+        timeout=int(app.config['HTTP_READ_TIMEOUT']),
+        transport=make_transport('github'),
+        commit_lock=(FileLock(app.config['COMMIT_LOCK_PATH'])
+                     if app.config['COMMIT_LOCK_PATH'] else None),
+        rate_limiter=RateLimiter(
+            reserve=app.config['GH_RATE_LIMIT_RESERVE']))
 
-githubx = Githubx(
-    app.config['GH_USER'],
-    app.config['GH_SECRET'],
-    user_agent='github.com/simon-weber/the-listserve-archive')
+
+@_once
+def group_committer():
+    """Return the GroupCommitter that concurrent ingest workers share, or
+    None if group commits are off."""
+    from githubx import GroupCommitter
+
+    if app.config['GROUP_COMMIT_WINDOW'] <= 0:
+        return None
+
+    return GroupCommitter(
+        githubx(),
+        window=app.config['GROUP_COMMIT_WINDOW'],
+        max_changes=app.config['GROUP_COMMIT_MAX_CHANGES'])
+
+
+@_once
+def dedup():
+    """Return the Deduplicator of handled messages and posts;
+    context.IO redelivers webhooks."""
+    return Deduplicator(app.config['DEDUP_SIZE'],
+                        app.config['DEDUP_PATH'] or None)
 
 
 @app.route('/cio/webhook', methods=['POST'])
 def receive_mail():
-    """POSTed to by context.IO when a new post is received."""
+    """POSTed to by context.IO when a new post is received.
+
+    The post is only queued here; ingest_queue's workers commit it."""
     app.logger.debug("received new post")
-    app.logger.debug(request.form)
-    app.logger.debug(request.json)
+    log_payload_sample('webhook', request.json)
 
     if not verify_webhook_post(request.json):
         return "invalid"
 
-    commit_post_data(request.json)
+    key = message_key(request.json)
+    if not dedup().claim(key):
+        #Already handled or queued.
+        DUPLICATES.inc(kind='message')
+        return "ok"
+
+    if not ingest_queue.put(request.json):
+        #context.IO will retry later.
+        dedup().release(key)
+        app.logger.warning("ingest queue full; refusing post")
+        return "busy", 503
 
     return "ok"
 
 
+@app.route('/metrics')
+def get_metrics():
+    """Scraped by Prometheus."""
+    ingest_queue.qsize()  # updates the depth gauge
+
+    return Response(metrics.REGISTRY.exposition(),
+                    mimetype=metrics.EXPOSITION_CONTENT_TYPE)
+
+
 @app.route('/cio/webhookfailure', methods=['GET', 'POST'])
 def handle_webhook_failure():
     """Context.IO might get or post at this for different kinds of failure."""
@@ -57,6 +208,15 @@ def handle_webhook_failure():
     return "ok"
 
 
+def log_payload_sample(label, payload):
+    """Debug-log a payload, for a LOG_SAMPLE_RATE fraction of calls.
+
+    Payloads are only serialized when they're logged."""
+
+    if random.random() < app.config['LOG_SAMPLE_RATE']:
+        app.logger.debug("%s (sampled): %s", label, json.dumps(payload))
+
+
 def verify_webhook_post(request_json):
     """Return True if the request is from context.IO.
 
@@ -69,44 +229,197 @@ def verify_webhook_post(request_json):
     return sig == request_json['signature']
 
 
-def commit_post_data(webhook_request_json, branch='gh-pages'):
-    """Commit a .html file in _posts/, a .json in data/, and append to the
-    cumulative .json in data/."""
+def message_key(webhook_request_json):
+    """Return the dedup key of the message a webhook is for."""
+    return 'message:' + webhook_request_json['message_data']['message_id']
+
+
+def post_key(post):
+    """Return the dedup key of a post's contents."""
+    return 'post:' + hashlib.sha1(json.dumps(post)).hexdigest()
+
+
+def warm_tree_cache():
+    """Fetch the site's tree in the background, so the first post's commit
+    finds it cached.
+
+    Posts don't wait for this; if it fails, their commits fetch it."""
+
+    def fetch():
+        try:
+            githubx().paths(ARCHIVE_REPO, SITE_BRANCH)
+        except Exception:
+            app.logger.exception("couldn't fetch the site's tree")
+
+    thread = Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+
+
+def release_failed_post(webhook_request_json):
+    """Let a redelivery of a webhook we gave up on be queued."""
+    dedup().release(message_key(webhook_request_json))
+
+
+def commit_post_data(webhook_request_json, branch=SITE_BRANCH):
+    """Commit a .html file in _posts/, the files for its day, and add it to
+    its shard of the cumulative .json in data/."""
 
     webhook = webhook_request_json  # convenience
 
     account_id = webhook['account_id']
     msg_id = webhook['message_data']['message_id']
 
-    msg = cio_requests.get(
-        "https://api.context.io/2.0/accounts/{aid}/messages/{mid}".format(
-            aid=account_id,
-            mid=msg_id),
-        params={'include_body': 1,
-                'body_type': 'text/plain'}
-    )
+    with STAGE_SECONDS.time(stage='cio_fetch'):
+        msg = cio_requests().get(
+            "{base}/2.0/accounts/{aid}/messages/{mid}".format(
+                base=app.config['CIO_BASE_URL'],
+                aid=account_id,
+                mid=msg_id),
+            params={'include_body': 1,
+                    'body_type': 'text/plain'}
+        )
+        message = msg.json()
 
     # context.io responded with a list once?
-    app.logger.debug('message response:')
-    app.logger.debug(msg.json())
+    log_payload_sample('message response', message)
+
+    with STAGE_SECONDS.time(stage='parse'):
+        from models import Post
+        post = Post.from_cio_message(message)
+
+    key = post_key(post)
+    if not dedup().claim(key):
+        #The same post, in a different message; handled or being handled.
+        app.logger.info("skipping duplicate post (%s)", post.datestr())
+        DUPLICATES.inc(kind='post')
+        dedup().done(message_key(webhook))
+        return
+
+    commit_kwargs = dict(
+        repo=ARCHIVE_REPO,
+        file_descriptions=post_files_builder(post),
+        commit_message="add post (%s)" % post.datestr(),
+        branch=branch)
 
-    post = Post.from_cio_message(msg.json())
+    try:
+        with STAGE_SECONDS.time(stage='commit'):
+            if group_committer() is not None:
+                group_committer().submit(**commit_kwargs).result()
+            else:
+                githubx().commit(**commit_kwargs)
+    except Exception:
+        #Let a retry, or another message with the post, commit it.
+        dedup().release(key)
+        raise
 
-    path_content_pairs = files_to_create(post)
+    POSTS.inc()
+    dedup().done(key)
+    dedup().done(message_key(webhook))
 
-    githubx.commit(
-        repo='the-listserve-archive',
-        file_descriptions=[file_description(*pair) for pair in path_content_pairs],
-        commit_message="add post (%s)" % post.datestr(),
-        branch=branch)
 
+def post_files_builder(post, fname=None):
+    """Return a function that renders post's files, for Githubx.commit.
+
+    Given read(path), which returns existing contents, it returns the file
+    descriptions of the post and of the day index and archive files it's
+    added to.
+
+    :param fname: the post's filename; by default, see post_fname.
+    """
+    import archive
+    from githubx import file_description
+    from models import read_day_index
+
+    def build_files(read):
+        with STAGE_SECONDS.time(stage='fetch_existing'):
+            day_index = read(day_index_path(post))
+            shard = read(archive.shard_path(post))
+            index = read(archive.INDEX_PATH)
+
+        with STAGE_SECONDS.time(stage='render'):
+            day_entries = read_day_index(day_index) if day_index else []
+
+            path_content_pairs = files_to_create(
+                post, day_entries,
+                fname=fname or post_fname(post, day_entries, read))
+            path_content_pairs += archive.files_to_update(post, shard, index)
+
+        return [file_description(*pair) for pair in path_content_pairs]
+
+    return build_files
+
+
+def post_fname(post, day_entries=(), read=None):
+    """Return the _posts filename of post, given the day index entries of the
+    posts on its day.
+
+    That's its jekyll_fname(), unless a different post already has it; then
+    it gets a numbered one. A post with the same subject and author as an
+    entry is the same post (eg redelivered), and keeps its filename.
 
-def files_to_create(post):
+    Posts from before there were day indexes aren't in them. So if given,
+    read(path), which returns existing contents or None, is used to check
+    _posts for filenames the entries don't have."""
+    from models import parse_frontmatter
+
+    entries = dict((entry['file'], entry) for entry in day_entries)
+
+    n = 1
+    while True:
+        fname = post.jekyll_fname(n)
+        entry = entries.get(fname)
+
+        if entry is None and read is not None:
+            contents = read(os.path.join('_posts', fname))
+            if contents is not None:
+                entry = parse_frontmatter(contents)['api_data']
+
+        if entry is None or ((entry['post']['subject'],
+                              entry['post']['author']) ==
+                             (post.subject, post.author)):
+            if n > 1:
+                app.logger.info("%s is taken; using %s",
+                                post.jekyll_fname(), fname)
+            return fname
+
+        n += 1
+
+
+def day_index_path(post):
+    """Return the path of the index of posts on the same day as post.
+
+    Layouts find it at site.data.days[datekey]."""
+    return os.path.join('_data', 'days', post.datestr() + '.yml')
+
+
+def files_to_create(post, day_entries=(), html_includes=None, fname=None):
     """Return a list of (filepath, contents) pairs.
 
+    day_entries are the day index entries of other posts on the same day;
+    an entry for this post replaces any existing one. The post's filename is
+    fname, or by default, chosen by post_fname.
+
+    The html of the body goes in _includes/, where the day's layouts include
+    it from. If html_includes is set (by default, if POST_HTML_INCLUDES is),
+    the post's layout does too, so its frontmatter leaves the html out.
+
     The first item in the list will be for _posts."""
+    from models import body_include, day_index_contents
+
+    if html_includes is None:
+        html_includes = app.config['POST_HTML_INCLUDES']
+
+    if fname is None:
+        fname = post_fname(post, day_entries)
+
+    _, jekyll_html = post.to_jekyll_html(fname, html_include=html_includes)
 
-    post_fname, jekyll_html = post.to_jekyll_html()
+    entries = dict((entry['file'], entry) for entry in day_entries)
+    entries[fname] = post.day_index_entry(fname)
+    #By filename, less '.html', so numbered ones follow the one they share.
+    fnames = sorted(entries, key=lambda f: os.path.splitext(f)[0])
+    day_index = day_index_contents([entries[f] for f in fnames])
 
     date_path = os.path.join(*post.datestr().split('-'))
 
@@ -116,15 +429,38 @@ def files_to_create(post):
     multipost_fname = date_path + '.html'
     jekyll_multipost = post.to_jekyll_multipost()
 
-    return [
-        (os.path.join('_posts', post_fname),
+    path_content_pairs = [
+        (os.path.join('_posts', fname),
          jekyll_html),
         (json_fname,
          jekyll_json),
         (multipost_fname,
          jekyll_multipost),
+        (day_index_path(post),
+         day_index),
+        (os.path.join('_includes', body_include(fname)),
+         post.to_jekyll_include()),
     ]
 
+    return path_content_pairs
+
+ingest_queue = IngestQueue(
+    app.config['SPOOL_DIR'],
+    commit_post_data,
+    maxsize=app.config['INGEST_QUEUE_SIZE'],
+    workers=app.config['INGEST_WORKERS'],
+    on_failure=release_failed_post,
+    logger=app.logger)
+
+
 if __name__ == '__main__':
+    #The development server; see wsgi.py for production.
+    app.debug = True
+
+    #With the debug reloader, only the child process serves requests.
+    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        ingest_queue.start()
+        warm_tree_cache()
+
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
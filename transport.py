@@ -0,0 +1,157 @@
+"""Timeouts, retries and a circuit breaker for calls to upstream APIs.
+
+One Transport is shared by everything that talks to a given service."""
+
+import random
+from threading import Lock
+import time
+
+import github
+from requests.adapters import HTTPAdapter
+import requests.exceptions
+
+import metrics
+
+RETRIES = metrics.REGISTRY.counter(
+    'transport_retries_total', 'Upstream calls retried, by service.')
+BREAKER_OPENS = metrics.REGISTRY.counter(
+    'transport_breaker_opens_total', 'Times a circuit breaker opened.')
+
+#Retried when responses have these statuses.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service that's been failing."""
+
+
+class CircuitBreaker(object):
+    def __init__(self, threshold=5, reset_after=60):
+        """Open after threshold consecutive failures.
+
+        Once reset_after seconds have passed, one call is let through; if it
+        succeeds, the breaker closes again."""
+
+        self.threshold = threshold
+        self.reset_after = reset_after
+
+        self._mutex = Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    def before_call(self):
+        """Raise CircuitOpenError if calls shouldn't be made now."""
+        with self._mutex:
+            if self._opened_at is None:
+                return
+
+            if time.time() - self._opened_at < self.reset_after:
+                raise CircuitOpenError()
+
+            #Half-open: let this call through, but hold off any others.
+            self._opened_at = time.time()
+
+    def succeeded(self):
+        with self._mutex:
+            self._failures = 0
+            self._opened_at = None
+
+    def failed(self):
+        """Return True if this failure opened the breaker."""
+        with self._mutex:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                opening = self._opened_at is None
+                self._opened_at = time.time()
+                return opening
+        return False
+
+
+class Transport(object):
+    def __init__(self, name, pool_size=10, connect_timeout=5, read_timeout=30,
+                 retries=3, backoff=0.5, max_backoff=30,
+                 breaker_threshold=5, breaker_reset_after=60):
+        """
+        :param name: the service, for metrics.
+        :param retries: how many times to retry a failed call.
+        :param backoff: the base delay before retrying; it doubles for each
+          retry, is jittered, and is capped at max_backoff.
+        """
+
+        self.name = name
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_after)
+
+    def delay(self, attempt):
+        """Return a 'full jitter' delay before retry number attempt.
+
+        Also used to space out retries made above the transport."""
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def _should_retry(self, response=None, exception=None):
+        if exception is not None:
+            if isinstance(exception, (requests.exceptions.ConnectionError,
+                                      requests.exceptions.Timeout)):
+                return True
+            if isinstance(exception, github.GithubException):
+                return exception.status >= 500
+            return False
+
+        return getattr(response, 'status_code', None) in RETRY_STATUSES
+
+    def call(self, func, *args, **kwargs):
+        """Return func(*args, **kwargs), retrying failures.
+
+        func may raise or return a requests Response; Responses with
+        retryable statuses are retried, and the last one is returned."""
+
+        for attempt in range(self.retries + 1):
+            self.breaker.before_call()
+
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                retry = self._should_retry(exception=e)
+                if retry:
+                    self._failed()
+                if not retry or attempt == self.retries:
+                    raise
+            else:
+                if not self._should_retry(response=response):
+                    self.breaker.succeeded()
+                    return response
+
+                self._failed()
+                if attempt == self.retries:
+                    return response
+
+            RETRIES.inc(service=self.name)
+            time.sleep(self.delay(attempt))
+
+    def _failed(self):
+        if self.breaker.failed():
+            BREAKER_OPENS.inc(service=self.name)
+
+    def mount(self, session):
+        """Pool, time out and retry every request made with a requests
+        Session. Return the session."""
+
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        request = session.request
+
+        def request_with_transport(method, url, **kwargs):
+            kwargs.setdefault('timeout', self.timeout)
+            return self.call(request, method, url, **kwargs)
+
+        session.request = request_with_transport
+
+        return session
@@ -0,0 +1,41 @@
+"""The production entry point, for a multi-process WSGI server::
+
+    gunicorn wsgi:app --workers 4 --threads 4
+
+Every worker process has its own ingest queue, but they share SPOOL_DIR and
+DEDUP_PATH, and commits are safe to make from any of them. By default they
+take turns committing, holding COMMIT_LOCK_PATH, and batch what arrives in the
+meantime into GROUP_COMMIT_WINDOW, rather than retrying after conflicts. They
+also share METRICS_DIR, so /metrics reports the totals of every worker,
+whichever one answers.
+
+Don't use --preload: the ingest threads must start after the fork."""
+
+import logging
+
+import metrics
+import tla
+
+#Unlike the debug server's, as there are several processes; the env still
+#overrides these.
+WSGI_DEFAULTS = {
+    'COMMIT_LOCK_PATH': 'commit.lock',
+    'GROUP_COMMIT_WINDOW': 0.2,
+}
+
+tla.load_env_conf(keys=(), defaults=WSGI_DEFAULTS)
+
+app = tla.app
+
+#Flask's own handlers only log errors outside of debug mode.
+_handler = logging.StreamHandler()
+_handler.setFormatter(logging.Formatter(
+    '%(asctime)s %(process)d %(levelname)s %(message)s'))
+app.logger.handlers[:] = [_handler]
+app.logger.setLevel(logging.INFO)
+
+if app.config['METRICS_DIR']:
+    metrics.REGISTRY.share(app.config['METRICS_DIR'])
+
+tla.ingest_queue.start()
+tla.warm_tree_cache()